@@ -18,6 +18,10 @@
 
 import susetest
 import twopence
+import hashlib
+import base64
+import shlex
+import urllib.parse
 import os
 
 from farthings.openssl_pki import PKI
@@ -27,6 +31,16 @@ class NginxConfig:
 		self.target = target
 		self.resource = fileResource
 		self._editor = None
+		self._serverIndex = None
+
+		# Transaction state, see beginTransaction()
+		self.transaction = False
+		self.modified = False
+		self.pendingFiles = {}
+
+		# Set by commit(): True if nginx.conf or any of the files was
+		# actually changed on the target
+		self.changed = False
 
 	@property
 	def editor(self):
@@ -37,14 +51,54 @@ class NginxConfig:
 			self._editor = self.resource.createEditor()
 		return self._editor
 
+	# Within a transaction, files passed to addFile/uploadFile are queued
+	# rather than written right away. commit() writes all of them in one go,
+	# skipping files whose content on the target is unchanged, and writes
+	# nginx.conf only if it has been modified through NginxServer or
+	# NginxLocation objects.
+	def beginTransaction(self):
+		self.transaction = True
+		self.modified = False
+		self.changed = False
+
+	def markModified(self):
+		self.modified = True
+
+	# Drop the queued files, and forget all changes to nginx.conf that
+	# have not been written yet. nginx.conf is re-read on next use.
+	def abort(self):
+		self.transaction = False
+		self.modified = False
+		self.pendingFiles = {}
+		self._editor = None
+		self.invalidateIndex()
+
 	def commit(self):
+		self.changed = False
+
+		transaction = self.transaction
+		self.transaction = False
+
+		if self.pendingFiles:
+			ok = self.flushFiles()
+			self.pendingFiles = {}
+			if not ok:
+				return False
+
 		if self._editor is None:
 			return True
 
+		# Outside of a transaction, we do not know whether someone
+		# modified the config directly, so always write it.
+		if transaction and not self.modified:
+			return True
+
 		if not self._editor.commit():
 			self.target.logFailure("Unable to commit modified nginx.conf")
 			return False
 
+		self.modified = False
+		self.changed = True
 		return True
 
 	@property
@@ -57,11 +111,68 @@ class NginxConfig:
 		dir = self.editor.proxy.parentDirectory
 		fileProxy = dir.createFile(name)
 
+		if self.transaction:
+			self.pendingFiles[name] = (fileProxy, data)
+			return name
+
 		twopence.debug(f"Writing {fileProxy.path}")
 		fileProxy.write(data)
 
 		return name
 
+	def flushFiles(self):
+		if self.isLocal:
+			return self.flushLocalFiles()
+		return self.flushRemoteFiles()
+
+	def flushLocalFiles(self):
+		for name, (fileProxy, data) in self.pendingFiles.items():
+			try:
+				with open(fileProxy.path, "rb") as f:
+					if f.read() == data:
+						twopence.debug(f"{fileProxy.path} is unchanged")
+						continue
+			except OSError:
+				pass
+
+			twopence.debug(f"Writing {fileProxy.path}")
+			fileProxy.write(data)
+			self.changed = True
+
+		return True
+
+	# Write all pending files using a single remote command. For each file,
+	# the script compares the sha256 of the existing file with that of the
+	# new content, and writes only those that differ. It prints the names
+	# of the files it wrote.
+	def flushRemoteFiles(self):
+		script = "set -e\n"
+		for name, (fileProxy, data) in self.pendingFiles.items():
+			path = shlex.quote(fileProxy.path)
+			digest = hashlib.sha256(data).hexdigest()
+
+			# Private keys should not be readable by anyone but root
+			umask = name.endswith(".key") and "077" or "022"
+
+			script += f"if [ \"$(sha256sum < {path} 2>/dev/null)\" != \"{digest}  -\" ]; then\n"
+			script += f"  (umask {umask}; base64 -d > {path}) <<'EOF'\n"
+			script += base64.encodebytes(data).decode('ascii')
+			script += "EOF\n"
+			script += f"  echo {path}\n"
+			script += "fi\n"
+
+		st = self.target.run("/bin/sh", stdin = script.encode('utf-8'), stdout = bytearray(),
+				user = "root", quiet = True)
+		if not st:
+			self.target.logFailure(f"Unable to write files: {st.message}")
+			return False
+
+		for path in st.stdoutString.split():
+			twopence.debug(f"Wrote {path}")
+			self.changed = True
+
+		return True
+
 	# FIXME: this should operate on FileProxy objects instead of local path names.
 	def uploadFile(self, localPath, name):
 		with open(localPath, "rb") as f:
@@ -85,20 +196,28 @@ class NginxConfig:
 		return iter(self.matchHttpServers())
 
 	def matchHttpServers(self, server_name = None, port = None):
-		primaryKeys = [
-			self.makeKey("http"),
-			self.makeKey("server")
-		]
-
-		secondaryKeys = []
-		if server_name:
-			secondaryKeys.append(self.makeKey(["server_name", server_name]))
-		if port:
-			secondaryKeys.append(self.makeKey(["listen", str(port)]))
+		return iter(self.serverIndex.match(server_name, port))
 
-		for block in self._editor.lookupEntryNested(primaryKeys):
-			if all(block.hasEntry(key) for key in secondaryKeys):
-				yield NginxServer(block)
+	# The server index is built on first use, by walking all server blocks
+	# nested inside the http block once. After that, it is kept up to date
+	# by createServer and by NginxServer when changing listen or server_name.
+	# If you modify server blocks behind our back, call invalidateIndex().
+	@property
+	def serverIndex(self):
+		if self._serverIndex is None:
+			primaryKeys = [
+				self.makeKey("http"),
+				self.makeKey("server")
+			]
+
+			index = NginxServerIndex()
+			for block in self.editor.lookupEntryNested(primaryKeys):
+				index.add(NginxServer(block, config = self))
+			self._serverIndex = index
+		return self._serverIndex
+
+	def invalidateIndex(self):
+		self._serverIndex = None
 
 	def findHttpServerUnique(self, **kwargs):
 		found = list(self.matchHttpServers(**kwargs))
@@ -116,8 +235,11 @@ class NginxConfig:
 		server = self.findHttpServerUnique(port = port)
 		if server is None:
 			block = self.httpBlock.createBlock("server")
-			server = NginxServer(block)
-			server.setPort(443, ssl = ssl)
+			self.markModified()
+
+			server = NginxServer(block, config = self)
+			server.setPort(port, ssl = ssl)
+			self.serverIndex.add(server)
 
 		server.fqdn = hostname
 		server.aliases = aliases
@@ -125,9 +247,64 @@ class NginxConfig:
 
 		return server
 
+# Index of server blocks by server name (including aliases) and by
+# listen port. Servers are kept in config file order.
+class NginxServerIndex:
+	def __init__(self):
+		self.servers = []
+		self.byName = {}
+		self.byPort = {}
+
+	def add(self, server):
+		server._index = self
+		self.servers.append(server)
+		self.register(server)
+
+	def register(self, server):
+		names, port = server.indexKeys()
+		for name in names:
+			self.byName.setdefault(name, []).append(server)
+		if port is not None:
+			self.byPort.setdefault(port, []).append(server)
+		server._indexKeys = (names, port)
+
+	def unregister(self, server):
+		names, port = server._indexKeys
+		for name in names:
+			self.byName[name].remove(server)
+		if port is not None:
+			self.byPort[port].remove(server)
+
+	# Called by NginxServer when its listen or server_name statement changes
+	def update(self, server):
+		self.unregister(server)
+		self.register(server)
+
+	# Returns a list of servers, in config file order
+	def match(self, server_name = None, port = None):
+		if not server_name and not port:
+			return list(self.servers)
+
+		candidates = None
+		if server_name:
+			candidates = self.byName.get(server_name, [])
+		if port:
+			found = self.byPort.get(str(port), [])
+			if candidates is None:
+				candidates = found
+			else:
+				found = set(found)
+				candidates = [server for server in candidates if server in found]
+
+		if len(candidates) > 1:
+			order = dict((id(server), n) for n, server in enumerate(self.servers))
+			return sorted(candidates, key = lambda server: order[id(server)])
+		return list(candidates)
+
 class BlockBackedObject:
-	def __init__(self, block):
+	def __init__(self, block, config = None):
 		self._block = block
+		self._config = config
 
 	def _get_value(self, keyword):
 		p = self._block.getProperty(keyword)
@@ -141,14 +318,30 @@ class BlockBackedObject:
 		return []
 
 	def _set_value(self, keyword, value):
+		self._checkModified(keyword, [value])
 		self._block.setProperty(keyword, value)
 
 	def _set_values(self, keyword, values):
+		self._checkModified(keyword, values)
 		self._block.setProperty(keyword, values)
 
+	def _checkModified(self, keyword, values):
+		if self._config is None:
+			return
+
+		if [str(v) for v in values] != [str(v) for v in self._get_values(keyword)]:
+			self._config.markModified()
+
 class NginxServer(BlockBackedObject):
-	def __init__(self, block, hostname = None, aliases = []):
-		super().__init__(block)
+	def __init__(self, block, hostname = None, aliases = [], config = None):
+		super().__init__(block, config)
+
+		# Set by NginxServerIndex.add
+		self._index = None
+		self._indexKeys = None
+
+		# Maps location path to NginxLocation
+		self._locations = {}
 
 		self.cacheClearFQDN()
 
@@ -198,7 +391,8 @@ class NginxServer(BlockBackedObject):
 		if ssl:
 			values.append("ssl")
 
-		self._block.setProperty("listen", values)
+		self._set_values("listen", values)
+		self.updateIndex()
 
 	@property
 	def server_name(self):
@@ -211,6 +405,7 @@ class NginxServer(BlockBackedObject):
 	def server_name(self, value):
 		self._set_value("server_name", value)
 		self.cacheClearFQDN()
+		self.updateIndex()
 
 	@property
 	def fqdn(self):
@@ -256,11 +451,22 @@ class NginxServer(BlockBackedObject):
 		for alias in self._aliases:
 			values += ["alias", alias]
 		self._set_values("server_name", values)
+		self.updateIndex()
 
 	def cacheClearFQDN(self):
 		self._fqdn = None
 		self._aliases = []
 
+	# Return the server names (primary name plus aliases) and the port this
+	# server should be indexed by
+	def indexKeys(self):
+		names = [word for word in self._get_values("server_name") if word != 'alias']
+		return names, self.port
+
+	def updateIndex(self):
+		if self._index is not None:
+			self._index.update(self)
+
 	@property
 	def charset(self):
 		return self._get_value("server_name")
@@ -301,12 +507,19 @@ class NginxServer(BlockBackedObject):
 		return self.ssl_certificate_key and self.ssl_certificate
 
 	def findLocation(self, path):
+		loc = self._locations.get(path)
+		if loc is not None:
+			return loc
+
 		found = list(self._block.matchBlocks(["location", path]))
 		if not found:
 			return None
 		if len(found) > 1:
 			raise KeyError(f"found multiple locations for {path}")
-		return NginxLocation(found[0])
+
+		loc = NginxLocation(found[0], self._config)
+		self._locations[path] = loc
+		return loc
 
 	def createLocation(self, path):
 		loc = self.findLocation(path)
@@ -314,7 +527,12 @@ class NginxServer(BlockBackedObject):
 			return loc
 
 		block = self._block.createBlock(["location", path])
-		return NginxLocation(block)
+		if self._config is not None:
+			self._config.markModified()
+
+		loc = NginxLocation(block, self._config)
+		self._locations[path] = loc
+		return loc
 
 class NginxLocation(BlockBackedObject):
 	@property
@@ -337,6 +555,9 @@ class NginxApplication(susetest.Application):
 	id = "nginx"
 	service_name = "nginx"
 
+	caName = "FancyCA"
+	caPassphrase = "rand0mP4ssphr4se"
+
 	def __init__(self, driver, target):
 		super().__init__(driver, target)
 
@@ -355,49 +576,112 @@ class NginxApplication(susetest.Application):
 
 		# We could turn PKI into an application as well
 		self.pki = PKI(driver.workspace)
-		self.ca = None
+		self.cas = {}
+
+		# The type of key used for the CA and server certificates.
+		# Any of the algorithms known to openssl_pki, eg "rsa",
+		# "ecdsa-p256", "ecdsa-p384" or "ed25519"
+		self.keyAlgorithm = "rsa"
 
 		if not self.config.isLocal:
 			self.pki.configureTarget(target)
 
+	# There is one CA per key algorithm
 	@property
 	def CA(self):
-		if self.ca is None:
-			self.ca = self.pki.createCA("FancyCA", passphrase = "rand0mP4ssphr4se")
-		return self.ca
+		return self.getCA(self.keyAlgorithm)
+
+	def getCA(self, keyAlgorithm):
+		ca = self.cas.get(keyAlgorithm)
+		if ca is None:
+			ca = self.pki.createCA(self.caName, passphrase = self.caPassphrase, keyAlgorithm = keyAlgorithm)
+			self.cas[keyAlgorithm] = ca
+		return ca
 
 	# FIXME: this should return a FileProxy, not a path
 	@property
 	def CACertificate(self):
-		if self.ca is None:
+		ca = self.cas.get(self.keyAlgorithm)
+		if ca is None:
 			return None
-		return self.ca.cert
+		return ca.cert
 
-	def createServer(self, **kwargs):
+	def createServer(self, keyAlgorithm = None, **kwargs):
 		withSSL = kwargs.get('ssl')
 
 		server = self.config.createServer(**kwargs)
 
 		if withSSL and not server.hasSSL:
-			self.createServerCertificate(server, server.fqdn, server.aliases)
+			self.createServerCertificate(server, server.fqdn, server.aliases, keyAlgorithm = keyAlgorithm)
 
 		loc = self.populateLocationDefaults(server, "/")
 		return server
 
-	def createServerCertificate(self, server, hostname = None, aliases = []):
+	def createServerCertificate(self, server, hostname = None, aliases = [], keyAlgorithm = None):
 		if hostname is None:
 			hostname = self.target.fqdn()
 		print("hostname is", hostname)
 
-		sslID = self.pki.createWebServer(self.CA, hostname, aliases = aliases)
+		if keyAlgorithm is None:
+			keyAlgorithm = self.keyAlgorithm
+
+		if self.pki.target is not None:
+			sslID = self.createRemoteServerCertificate(hostname, aliases, keyAlgorithm)
+			if sslID is None:
+				return None
+		else:
+			sslID = self.pki.createWebServer(self.getCA(keyAlgorithm), hostname, aliases = aliases)
+
+		name = hostname
+		if keyAlgorithm != "rsa":
+			name += f"-{keyAlgorithm}"
 
 		# Now copy the certificates to /etc/nginx
-		server.ssl_certificate = self.config.uploadFile(sslID.cert.path, f"{hostname}.pem")
-		server.ssl_certificate_key = self.config.uploadFile(sslID.key.path, f"{hostname}.key")
+		server.ssl_certificate = self.config.uploadFile(sslID.cert.path, f"{name}.pem")
+		server.ssl_certificate_key = self.config.uploadFile(sslID.key.path, f"{name}.key")
 		server.ssl_protocols = ["TLSv1.2"]
 
 		return sslID
 
+	# When the PKI operates on the SUT, create the CA (if we do not have
+	# it yet) and the server identity in one remote command
+	def createRemoteServerCertificate(self, hostname, aliases, keyAlgorithm):
+		ca, servers = self.pki.createRemoteIdentities(self.caName, [(hostname, aliases)],
+					passphrase = self.caPassphrase,
+					keyAlgorithm = keyAlgorithm)
+		if ca is None:
+			self.target.logFailure(f"Unable to create certificate for {hostname}")
+			return None
+
+		self.cas[keyAlgorithm] = ca
+		return servers[0]
+
+	# Collect config changes and certificate uploads, and apply them
+	# all at once in commitTransaction()
+	def beginTransaction(self):
+		self.config.beginTransaction()
+
+	# Write out nginx.conf and any files that changed, and reload the
+	# service once if anything changed at all
+	def commitTransaction(self):
+		if not self.config.commit():
+			return False
+
+		if not self.config.changed:
+			self.target.logInfo("nginx configuration unchanged; not reloading")
+			return True
+
+		self.target.logInfo("Trying to reload nginx service")
+		if not self.reload():
+			self.target.logFailure("Unable to reload nginx service")
+			return False
+
+		return True
+
+	# Discard everything queued since beginTransaction()
+	def abortTransaction(self):
+		self.config.abort()
+
 	def populateLocationDefaults(self, server, path):
 		loc = server.createLocation(path)
 		if loc.root is None:
@@ -419,3 +703,76 @@ class NginxApplication(susetest.Application):
 	def serverUrls(self, **kwargs):
 		for server in self.config.matchHttpServers(**kwargs):
 			yield server.url
+
+	# After a reload, wait until nginx accepts connections on all the
+	# addresses it is supposed to listen on. All URLs are probed in
+	# parallel, by a single script running on the server. Each probe
+	# retries with exponential backoff (minDelay doubling up to maxDelay,
+	# in seconds) until the port accepts a TCP connection or the overall
+	# deadline expires.
+	#
+	# Returns a dict mapping each URL to the time (in seconds) it took
+	# to become ready, or None if it did not become ready in time.
+	def waitReady(self, deadline = 10, minDelay = 0.05, maxDelay = 1, **kwargs):
+		probes = []
+		for url in self.serverUrls(**kwargs):
+			parsed = urllib.parse.urlsplit(url)
+			port = parsed.port or (parsed.scheme == "https" and 443 or 80)
+			probes.append((url, parsed.hostname, port))
+
+		if not probes:
+			return {}
+
+		script = self.waitReadyScript(deadline, minDelay, maxDelay)
+		for url, host, port in probes:
+			script += f"probe {shlex.quote(url)} {shlex.quote(host)} {port} &\n"
+		script += "wait\n"
+
+		st = self.target.run("/bin/bash", stdin = script.encode('utf-8'), stdout = bytearray(),
+				timeout = deadline + 30, quiet = True)
+		if not st:
+			self.target.logFailure(f"Unable to probe nginx: {st.message}")
+			return dict((url, None) for url, host, port in probes)
+
+		result = dict((url, None) for url, host, port in probes)
+		for line in st.stdoutString.splitlines():
+			words = line.split(maxsplit = 2)
+			if len(words) != 3:
+				continue
+
+			status, msec, url = words
+			if status == "ready":
+				result[url] = int(msec) / 1000
+				self.target.logInfo(f"{url} ready after {result[url]:.3f}s")
+			else:
+				self.target.logInfo(f"{url} not ready after {int(msec) / 1000:.3f}s")
+
+		return result
+
+	@staticmethod
+	def waitReadyScript(deadline, minDelay, maxDelay):
+		deadline = int(deadline * 1000)
+		minDelay = max(1, int(minDelay * 1000))
+		maxDelay = max(minDelay, int(maxDelay * 1000))
+
+		return f"""start=$(date +%s%N)
+elapsed() {{ echo $(( ($(date +%s%N) - start) / 1000000 )); }}
+probe() {{
+	local delay={minDelay}
+	while :; do
+		if timeout 1 bash -c "exec 3<>/dev/tcp/$2/$3" 2>/dev/null; then
+			echo "ready $(elapsed) $1"
+			return
+		fi
+		local remaining=$(({deadline} - $(elapsed)))
+		if [ $remaining -le 0 ]; then
+			echo "timeout $(elapsed) $1"
+			return
+		fi
+		[ $delay -le $remaining ] || delay=$remaining
+		sleep $(printf '%d.%03d' $((delay / 1000)) $((delay % 1000)))
+		delay=$((delay * 2))
+		[ $delay -le {maxDelay} ] || delay={maxDelay}
+	done
+}}
+"""
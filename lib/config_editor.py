@@ -0,0 +1,126 @@
+##################################################################
+#
+# Batched editing of simple config files on a node
+#
+# Many daemons use config files with one statement per line, where
+# the first word is the keyword (chrony.conf, chrony.keys, ...). This
+# editor collects line level edits for any number of such files, and
+# applies all of them with a single remote command when you call
+# commit(). Files whose content does not change are not rewritten,
+# and commit() tells you which files did change, so that callers
+# can decide whether the service needs to be restarted.
+#
+# Copyright (C) 2022, Olaf Kirch <okir@suse.com>
+#
+##################################################################
+
+import twopence
+import base64
+import shlex
+
+# Replace lines whose first word is listed in the keyword file with the
+# lines from the replacement file. The replacement goes where the first
+# matching line was; if there was none, it is appended.
+AWK_REPLACE = '''
+BEGIN {
+	while ((getline word < keywords) > 0)
+		remove[word] = 1
+}
+($1 in remove) {
+	if (!done) {
+		while ((getline line < replacement) > 0)
+			print line
+		done = 1
+	}
+	next
+}
+{ print }
+END {
+	if (!done) {
+		while ((getline line < replacement) > 0)
+			print line
+	}
+}
+'''
+
+class BatchFileEditor:
+	def __init__(self, node, user = "root"):
+		self.node = node
+		self.user = user
+
+		self.edits = {}
+		self.commands = []
+
+	# Replace all lines starting with one of the given keywords with
+	# replacementLines.
+	def replaceLines(self, path, keywords, replacementLines):
+		self.edits.setdefault(path, []).append((keywords, replacementLines))
+
+	# Queue a shell command to be run after the files have been written
+	def addCommand(self, command):
+		self.commands.append(command)
+
+	def heredoc(self, path, lines):
+		data = "".join(line + "\n" for line in lines).encode('utf-8')
+
+		result = f"base64 -d > {path} <<'EOF'\n"
+		result += base64.encodebytes(data).decode('ascii')
+		result += "EOF\n"
+		return result
+
+	def buildScript(self):
+		script = "set -e\n" \
+			 "dir=$(mktemp -d)\n" \
+			 "trap 'rm -rf \"$dir\"' EXIT\n"
+		script += "cat > \"$dir/replace.awk\" <<'EOF'\n" + AWK_REPLACE + "EOF\n"
+
+		for n, (path, edits) in enumerate(self.edits.items()):
+			path = shlex.quote(path)
+			work = f"\"$dir/file{n}\""
+
+			script += f"cat {path} > {work}\n"
+			for keywords, replacementLines in edits:
+				script += self.heredoc("\"$dir/keywords\"", keywords)
+				script += self.heredoc("\"$dir/replacement\"", replacementLines)
+				script += f"awk -v keywords=\"$dir/keywords\" -v replacement=\"$dir/replacement\" " \
+					  f"-f \"$dir/replace.awk\" {work} > \"$dir/new\"\n"
+				script += f"mv \"$dir/new\" {work}\n"
+
+			# Overwrite in place to retain ownership and permissions
+			script += f"if ! cmp -s {work} {path}; then\n" \
+				  f"	cat {work} > {path}\n" \
+				  f"	echo changed {path}\n" \
+				  f"fi\n"
+
+		for command in self.commands:
+			script += command + "\n"
+
+		return script
+
+	# Apply all queued edits. Returns the list of files that were
+	# modified, or None on error.
+	def commit(self):
+		if not self.edits and not self.commands:
+			return []
+
+		node = self.node
+		node.logInfo("Editing %s" % ", ".join(self.edits.keys()))
+
+		script = self.buildScript()
+		self.edits = {}
+		self.commands = []
+
+		st = node.run("/bin/sh", stdin = script.encode('utf-8'), stdout = bytearray(),
+				user = self.user, quiet = True)
+		if not st:
+			node.logError("Unable to edit files: %s" % st.message)
+			return None
+
+		changed = []
+		for line in st.stdoutString.splitlines():
+			words = line.split(maxsplit = 1)
+			if len(words) == 2 and words[0] == "changed":
+				changed.append(words[1])
+				twopence.debug("Modified %s" % words[1])
+
+		return changed
@@ -0,0 +1,119 @@
+##################################################################
+#
+# Wait for a fencepost file to appear on a node
+#
+# Tests for job schedulers (at, cron, ...) typically schedule a job
+# that touches a file, and then wait for that file to show up. Rather
+# than polling with one remote command per second, we run a single
+# command on the node that waits for the file, using inotifywait if
+# available, and stat polling otherwise. While waiting, it prints a
+# line every few seconds so that the twopence connection does not
+# go idle.
+#
+# Copyright (C) 2022, Olaf Kirch <okir@suse.com>
+#
+##################################################################
+
+import susetest
+import twopence
+import shlex
+
+from farthings.percentiles import percentile
+
+# Arguments: timeout path...
+#
+# If a file contains a timestamp (as written by "date +%s.%N"), that is
+# reported as the time it appeared; otherwise, its mtime is used.
+WAIT_SCRIPT = '''
+deadline=$(($(date +%s) + $1))
+shift
+
+dirs=$(for path; do dirname "$path"; done | sort -u)
+
+if command -v inotifywait >/dev/null 2>&1; then
+	method=inotify
+else
+	method=poll
+fi
+echo "waiting for $# file(s) using $method"
+polls=0
+
+while :; do
+	for path in "$@"; do
+		shift
+		if [ -e "$path" ]; then
+			when=$(cat "$path" 2>/dev/null)
+			[ -n "$when" ] || when=$(date -r "$path" +%s.%N)
+			echo "found $when $path"
+		else
+			set -- "$@" "$path"
+		fi
+	done
+
+	[ $# -gt 0 ] || exit 0
+
+	remaining=$((deadline - $(date +%s)))
+	if [ $remaining -le 0 ]; then
+		echo "timeout"
+		exit 1
+	fi
+	[ $remaining -le 5 ] || remaining=5
+
+	case $method in
+	inotify)
+		inotifywait -qq -t $remaining -e create -e moved_to -e attrib $dirs >/dev/null 2>&1;;
+	poll)
+		sleep 0.2
+		polls=$((polls + 1))
+		[ $((polls % 25)) -eq 0 ] || continue;;
+	esac
+	echo "still waiting"
+done
+'''
+
+# Wait up to timeout seconds for the file to appear. Returns the time
+# the file was created (as seconds since the epoch on the node's clock),
+# or None if it did not show up in time.
+def waitForFencepost(node, path, timeout, user = None):
+	susetest.say(f"Waiting for fencepost file {path} to appear (timeout {timeout} seconds)")
+
+	when = waitForFenceposts(node, [path], timeout, user).get(path)
+	if when is not None:
+		twopence.info(f"Fencepost file {path} appeared at {when:.3f}")
+	return when
+
+# Same as above, for a list of files. Returns a dict mapping the path
+# names of the files that did show up to their creation time.
+def waitForFenceposts(node, paths, timeout, user = None):
+	kwargs = {}
+	if user is not None:
+		kwargs['user'] = user
+
+	command = f"/bin/sh -s {int(timeout)} " + " ".join(shlex.quote(path) for path in paths)
+	st = node.run(command, stdin = WAIT_SCRIPT.encode('utf-8'), stdout = bytearray(),
+			timeout = timeout + 30, quiet = True, **kwargs)
+
+	result = {}
+	for line in st.stdoutString.splitlines():
+		words = line.split(maxsplit = 2)
+		if len(words) == 3 and words[0] == "found":
+			try:
+				result[words[2]] = float(words[1])
+			except ValueError:
+				twopence.error(f"Cannot parse timestamp \"{words[1]}\" in {words[2]}")
+
+	return result
+
+# Given a list of delays (in seconds), return min, median, p99 and max
+def delayStatistics(delays):
+	if not delays:
+		return None
+
+	delays = sorted(delays)
+	return {
+		"count":	len(delays),
+		"min":		delays[0],
+		"median":	percentile(delays, 50),
+		"p99":		percentile(delays, 99),
+		"max":		delays[-1],
+	}
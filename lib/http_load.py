@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+##################################################################
+#
+# Simple HTTP(S) load generator
+#
+# This module is used in two ways. Test scripts import it to interpret
+# the results, and copy it to the client node where it is executed as
+# a script, eg
+#
+#  python3 http_load.py runtime=10 connections=16 \
+#		http://server/ https://server/@TLSv1.2 https://server/@TLSv1.3
+#
+# A protocol version appended to an https URL forces that TLS version.
+# For each URL, the given number of keep-alive connections request the
+# URL over and over again until the runtime is up. The results are
+# printed as JSON on standard output.
+#
+# Copyright (C) 2022, Olaf Kirch <okir@suse.com>
+#
+##################################################################
+
+import http.client
+import threading
+import json
+import time
+import ssl
+import sys
+import urllib.parse
+
+tlsVersions = {
+	"TLSv1.2":	"TLSv1_2",
+	"TLSv1.3":	"TLSv1_3",
+}
+
+##################################################################
+# Latency histogram with logarithmic buckets. Each power of two
+# (in microseconds) is split into subBuckets linear sub-buckets, so
+# the relative error of the reported percentiles is below 1/subBuckets.
+# subBuckets must be a power of two.
+##################################################################
+class LatencyHistogram:
+	subBuckets = 8
+	subBits = subBuckets.bit_length() - 1
+	subMask = subBuckets - 1
+
+	def __init__(self):
+		self.counts = {}
+		self.count = 0
+		self.total = 0
+		self.min = None
+		self.max = 0
+
+	def bucketFor(self, usec):
+		if usec < self.subBuckets:
+			return usec
+
+		shift = usec.bit_length() - self.subBuckets.bit_length()
+		return (shift << self.subBits) + (usec >> shift)
+
+	def bucketLimit(self, bucket):
+		if bucket < self.subBuckets:
+			return bucket + 1
+
+		shift = (bucket >> self.subBits) - 1
+		return ((bucket & self.subMask) + self.subBuckets + 1) << shift
+
+	def record(self, seconds):
+		usec = int(seconds * 1000000)
+
+		bucket = self.bucketFor(usec)
+		self.counts[bucket] = self.counts.get(bucket, 0) + 1
+		self.count += 1
+		self.total += usec
+		if self.min is None or usec < self.min:
+			self.min = usec
+		if usec > self.max:
+			self.max = usec
+
+	def merge(self, other):
+		for bucket, count in other.counts.items():
+			self.counts[bucket] = self.counts.get(bucket, 0) + count
+		self.count += other.count
+		self.total += other.total
+		if other.min is not None and (self.min is None or other.min < self.min):
+			self.min = other.min
+		self.max = max(self.max, other.max)
+
+	# Returns the upper limit of the bucket containing the given
+	# percentile, in seconds
+	def percentile(self, pct):
+		if not self.count:
+			return None
+
+		threshold = self.count * pct / 100
+		seen = 0
+		for bucket in sorted(self.counts):
+			seen += self.counts[bucket]
+			if seen >= threshold:
+				return min(self.bucketLimit(bucket), self.max) / 1000000
+		return self.max / 1000000
+
+	def asDict(self):
+		return {
+			"count":	self.count,
+			"mean":		self.total / self.count / 1000000 if self.count else None,
+			"min":		self.min / 1000000 if self.min is not None else None,
+			"max":		self.max / 1000000,
+			"p50":		self.percentile(50),
+			"p90":		self.percentile(90),
+			"p99":		self.percentile(99),
+			"buckets":	[[self.bucketLimit(b) / 1000000, self.counts[b]] for b in sorted(self.counts)],
+		}
+
+class LoadResult:
+	def __init__(self, url, protocol):
+		self.url = url
+		self.protocol = protocol
+		self.requests = 0
+		self.errors = 0
+		self.handshakeFailures = 0
+		self.elapsed = 0
+		self.histogram = LatencyHistogram()
+		self.lastError = None
+
+	def merge(self, other):
+		self.requests += other.requests
+		self.errors += other.errors
+		self.handshakeFailures += other.handshakeFailures
+		self.histogram.merge(other.histogram)
+		if other.lastError:
+			self.lastError = other.lastError
+
+	@property
+	def requestsPerSecond(self):
+		if not self.elapsed:
+			return 0
+		return self.requests / self.elapsed
+
+	def asDict(self):
+		return {
+			"url":			self.url,
+			"protocol":		self.protocol,
+			"requests":		self.requests,
+			"errors":		self.errors,
+			"handshakeFailures":	self.handshakeFailures,
+			"elapsed":		self.elapsed,
+			"requestsPerSecond":	self.requestsPerSecond,
+			"latency":		self.histogram.asDict(),
+			"lastError":		self.lastError,
+		}
+
+class Connection:
+	def __init__(self, url, protocol = None, timeout = 10):
+		parsed = urllib.parse.urlsplit(url)
+
+		self.host = parsed.hostname
+		self.port = parsed.port
+		self.path = parsed.path or "/"
+		self.timeout = timeout
+
+		self.context = None
+		if parsed.scheme == "https":
+			self.context = ssl.create_default_context()
+			if protocol is not None:
+				version = getattr(ssl.TLSVersion, tlsVersions[protocol])
+				self.context.minimum_version = version
+				self.context.maximum_version = version
+
+		self.conn = None
+
+	def connect(self):
+		if self.context is not None:
+			self.conn = http.client.HTTPSConnection(self.host, self.port, timeout = self.timeout, context = self.context)
+		else:
+			self.conn = http.client.HTTPConnection(self.host, self.port, timeout = self.timeout)
+		self.conn.connect()
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+	def request(self):
+		if self.conn is None:
+			self.connect()
+
+		self.conn.request("GET", self.path)
+		response = self.conn.getresponse()
+		response.read()
+
+		if response.will_close:
+			self.close()
+		return response.status
+
+def worker(url, protocol, endTime, result):
+	conn = Connection(url, protocol)
+	while time.monotonic() < endTime:
+		t0 = time.monotonic()
+		try:
+			status = conn.request()
+		except ssl.SSLError as e:
+			result.handshakeFailures += 1
+			result.lastError = str(e)
+			conn.close()
+
+			# Retrying will not help
+			break
+		except (OSError, http.client.HTTPException) as e:
+			result.errors += 1
+			result.lastError = str(e)
+			conn.close()
+			continue
+
+		result.histogram.record(time.monotonic() - t0)
+		result.requests += 1
+		if status != 200:
+			result.errors += 1
+			result.lastError = f"HTTP status {status}"
+
+	conn.close()
+
+def runLoad(url, protocol = None, runtime = 10, connections = 16):
+	results = [LoadResult(url, protocol) for i in range(connections)]
+
+	t0 = time.monotonic()
+	endTime = t0 + runtime
+
+	threads = []
+	for result in results:
+		t = threading.Thread(target = worker, args = (url, protocol, endTime, result))
+		t.start()
+		threads.append(t)
+
+	for t in threads:
+		t.join()
+
+	total = LoadResult(url, protocol)
+	total.elapsed = time.monotonic() - t0
+	for result in results:
+		total.merge(result)
+	return total
+
+if __name__ == '__main__':
+	runtime = 10
+	connections = 16
+	targets = []
+
+	for arg in sys.argv[1:]:
+		if '=' in arg:
+			name, value = arg.split('=', 1)
+			if name == "runtime":
+				runtime = float(value)
+			elif name == "connections":
+				connections = int(value)
+			else:
+				print(f"Unknown argument {arg}", file = sys.stderr)
+				sys.exit(1)
+			continue
+
+		protocol = None
+		if '@' in arg:
+			arg, protocol = arg.rsplit('@', 1)
+			if protocol not in tlsVersions:
+				print(f"Unknown protocol {protocol}", file = sys.stderr)
+				sys.exit(1)
+		targets.append((arg, protocol))
+
+	# Load the URLs one after the other, so that they do not compete
+	# with each other for CPU
+	report = []
+	for url, protocol in targets:
+		result = runLoad(url, protocol, runtime, connections)
+		report.append(result.asDict())
+
+	json.dump(report, sys.stdout, indent = 2)
+	print()
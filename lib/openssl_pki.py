@@ -7,11 +7,43 @@
 #
 ##################################################################
 
+import concurrent.futures
+import abc
+import functools
 import subprocess
+import tarfile
+import shlex
+import io
+import threading
 import twopence
 import tempfile
+import datetime
+import fcntl
+import hashlib
+import base64
+import shutil
+import json
+import time
 import os
 
+# When run as a script (see the benchmark below), the farthings
+# package may not be installed
+try:
+	from farthings.percentiles import percentile
+except ImportError:
+	from percentiles import percentile
+
+# The cryptography package is optional. If it is available, we can do
+# all the key and certificate handling in-process rather than forking
+# openssl for every single step.
+try:
+	from cryptography import x509
+	from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+	from cryptography.hazmat.primitives import hashes, serialization
+	from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+except ImportError:
+	x509 = None
+
 DEFAULT_CONFIG = '''
 [ req ]
 #default_bits		= 2048
@@ -39,31 +71,82 @@ challengePassword_min   = 4
 challengePassword_max   = 20
 '''
 
+##################################################################
+# Supported key algorithms
+#
+# For each algorithm, we record how to generate a key using
+# openssl genpkey, which openssl subcommand handles this type of
+# key, and which digest to use when signing with it.
+##################################################################
+class KeyAlgorithm:
+	def __init__(self, name, genpkeyArgs, command = "pkey", curve = None, digest = "sha256"):
+		self.name = name
+		self.genpkeyArgs = genpkeyArgs
+		self.command = command
+		self.curve = curve
+		self.digest = digest
+
+	def genpkeyOptions(self, bits):
+		if self.name == "rsa":
+			return self.genpkeyArgs + ["-pkeyopt", f"rsa_keygen_bits:{bits}"]
+		return self.genpkeyArgs
+
+keyAlgorithms = {}
+for _alg in (
+		KeyAlgorithm("rsa",
+			["-algorithm", "RSA"],
+			command = "rsa"),
+		KeyAlgorithm("ecdsa-p256",
+			["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-256", "-pkeyopt", "ec_param_enc:named_curve"],
+			curve = "SECP256R1"),
+		KeyAlgorithm("ecdsa-p384",
+			["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-384", "-pkeyopt", "ec_param_enc:named_curve"],
+			curve = "SECP384R1"),
+		KeyAlgorithm("ed25519",
+			["-algorithm", "ED25519"],
+			digest = None),
+		):
+	keyAlgorithms[_alg.name] = _alg
+
+def getKeyAlgorithm(name):
+	alg = keyAlgorithms.get(name)
+	if alg is None:
+		raise ValueError(f"Unsupported key algorithm \"{name}\"")
+	return alg
+
 class Config:
 	def __init__(self):
 		self.extensions = []
 		self.extensionLines = []
 
 		self.file = None
+		self.extensionFile = None
+
+	@property
+	def extensionText(self):
+		return "".join(line + "\n" for line in self.extensionLines)
+
+	@property
+	def text(self):
+		return DEFAULT_CONFIG + self.extensionText
 
 	@property
 	def path(self):
 		if self.file is None:
-			self.file = tempfile.NamedTemporaryFile(mode = "w", prefix = "pki-", suffix = ".conf")
-			self.file.write(DEFAULT_CONFIG)
-			for line in self.extensionLines:
-				print(line, file = self.file)
-			self.file.flush()
+			self.file = self.writeTempFile(self.text)
 		return self.file.name
 
 	@property
 	def extensionPath(self):
-		if self.file is None:
-			self.file = tempfile.NamedTemporaryFile(mode = "w", prefix = "pki-", suffix = ".conf")
-			for line in self.extensionLines:
-				print(line, file = self.file)
-			self.file.flush()
-		return self.file.name
+		if self.extensionFile is None:
+			self.extensionFile = self.writeTempFile(self.extensionText)
+		return self.extensionFile.name
+
+	def writeTempFile(self, text):
+		file = tempfile.NamedTemporaryFile(mode = "w", prefix = "pki-", suffix = ".conf")
+		file.write(text)
+		file.flush()
+		return file
 
 	def applyRequestParameters(self, req):
 		extSection = []
@@ -96,64 +179,255 @@ class CertificateParameters:
 		self.validity = 365
 		self.CA = CA
 
+		self._config = None
+
 	def addAltSubjectName(self, type, name):
 		type = type.upper()
 		if type not in ('DNS', ):
 			raise ValueError(f"Bad type {type} for subjectAltName {name}")
 		self.altSubjectNames.append(f"{type}:{name}")
+		self._config = None
 
+	# The config is built once, and shared by all openssl invocations
+	# that use these parameters
 	def generateConfig(self):
-		config = Config()
-		config.applyRequestParameters(self)
-		return config
-
+		if self._config is None:
+			config = Config()
+			config.applyRequestParameters(self)
+			self._config = config
+		return self._config
+
+	# Returns a hash over everything that goes into a certificate
+	# issued with these parameters
+	@property
+	def digest(self):
+		h = hashlib.sha256()
+		for item in (self.subject,
+			     ",".join(self.altSubjectNames),
+			     self.extendedKeyUsage or "",
+			     str(self.validity),
+			     str(self.CA)):
+			h.update(item.encode('utf-8'))
+			h.update(b'\0')
+		return h.hexdigest()
+
+# Keys, CSRs and certificates are held in memory as PEM blobs.
+#
+# If the object was created with a path name, the data is read from
+# that file on first access, and written to it when updated. Objects
+# without a path live in memory only; a temporary file is created only
+# if someone asks for the path.
 class FileBackedThing:
 	file_suffix = None
+	file_mode = 0o644
 
-	def __init__(self, path):
+	def __init__(self, path = None, data = None):
 		assert(self.file_suffix)
 
 		self.file = None
-		if path is None:
-			self.file = tempfile.NamedTemporaryFile(mode = "w", suffix = self.file_suffix)
-			path = self.file.name
-		self.path = path
+		self._path = path
+		self._data = data
+		self._decoded = None
+
+	@property
+	def hasPath(self):
+		return self._path is not None
+
+	@property
+	def path(self):
+		if self._path is None:
+			self.file = tempfile.NamedTemporaryFile(mode = "wb", suffix = self.file_suffix)
+			if self._data is not None:
+				self.file.write(self._data)
+				self.file.flush()
+			self._path = self.file.name
+		return self._path
+
+	@property
+	def data(self):
+		if self._data is None and self._path is not None:
+			with open(self._path, "rb") as f:
+				self._data = f.read()
+		return self._data
+
+	@data.setter
+	def data(self, value):
+		self._data = value
+		self._decoded = None
+		if self._path is not None:
+			writeFile(self._path, value, self.file_mode)
+
+	# Call this when someone other than us has updated the file
+	def invalidate(self):
+		if self._path is not None:
+			self._data = None
+			self._decoded = None
+
+# Certificates and CSRs can be inspected in-process, without having
+# to fork openssl. The PEM data is decoded on first access of any of
+# the properties below, and cached until the data changes.
+#
+# Names are returned in the same notation used by CertificateParameters,
+# ie subject "/CN=foo", SANs "DNS:foo", EKUs "serverAuth", so that they
+# can be compared directly.
+class X509Thing(FileBackedThing, metaclass = abc.ABCMeta):
+	@abc.abstractmethod
+	def decode(self, data):
+		pass
+
+	@property
+	def decoded(self):
+		if self._decoded is None:
+			if x509 is None:
+				raise ImportError("Inspecting certificates requires the python cryptography package")
+			if self.data is None:
+				raise ValueError(f"{self.__class__.__name__} object has no data")
+			self._decoded = self.decode(self.data)
+		return self._decoded
+
+	@property
+	def subject(self):
+		return formatName(self.decoded.subject)
+
+	@property
+	def altSubjectNames(self):
+		ext = self.getExtension(x509.SubjectAlternativeName)
+		if ext is None:
+			return []
+		return [f"DNS:{name}" for name in ext.get_values_for_type(x509.DNSName)]
+
+	@property
+	def extendedKeyUsage(self):
+		ext = self.getExtension(x509.ExtendedKeyUsage)
+		if ext is None:
+			return []
+
+		names = dict((getattr(ExtendedKeyUsageOID, oid), name)
+				for name, oid in CryptographyBackend.extendedKeyUsages.items())
+		return [names.get(oid, oid.dotted_string) for oid in ext]
+
+	# Returns "CA:TRUE" or "CA:FALSE", as in the openssl config file,
+	# or None if the extension is not present
+	@property
+	def basicConstraints(self):
+		ext = self.getExtension(x509.BasicConstraints)
+		if ext is None:
+			return None
+
+		result = "CA:TRUE" if ext.ca else "CA:FALSE"
+		if ext.path_length is not None:
+			result += f", pathlen:{ext.path_length}"
+		return result
+
+	@property
+	def isCA(self):
+		return self.basicConstraints is not None and self.basicConstraints.startswith("CA:TRUE")
+
+	def getExtension(self, extClass):
+		try:
+			return self.decoded.extensions.get_extension_for_class(extClass).value
+		except x509.ExtensionNotFound:
+			return None
+
+def formatName(name):
+	types = dict((getattr(NameOID, oid), type)
+			for type, oid in CryptographyBackend.subjectAttributes.items())
+
+	result = ""
+	for attr in name:
+		type = types.get(attr.oid, attr.oid.dotted_string)
+		result += f"/{type}={attr.value}"
+	return result
 
 class Key(FileBackedThing):
 	file_suffix = ".key"
+	file_mode = 0o600
 
-	def __init__(self, path, passphrase = None):
+	def __init__(self, path = None, passphrase = None, algorithm = "rsa"):
 		super().__init__(path)
 		self.passphrase = passphrase
+		self.algorithm = getKeyAlgorithm(algorithm).name
+
+	@property
+	def keyAlgorithm(self):
+		return getKeyAlgorithm(self.algorithm)
 
-class CSR(FileBackedThing):
+class CSR(X509Thing):
 	file_suffix = ".csr"
 
 	def __init__(self, path = None, params = None, privateKey = None):
 		super().__init__(path)
 		self.privateKey = privateKey
 		self.params = params
-		return
 
-		self.file = None
-		if path is None:
-			self.file = tempfile.NamedTemporaryFile(mode = "w", suffix = ".csr")
-			path = self.file.name
-		self.path = path
+	def decode(self, data):
+		return x509.load_pem_x509_csr(data)
+
+class Certificate(X509Thing):
+	file_suffix = ".cert"
 
-class Certificate:
 	def __init__(self, path = None, privateKey = None):
+		super().__init__(path)
 		self.privateKey = privateKey
-		self.file = None
-		if path is None:
-			self.file = tempfile.NamedTemporaryFile(mode = "w", suffix = ".cert")
-			path = self.file.name
-		self.path = path
+
+	def decode(self, data):
+		return x509.load_pem_x509_certificate(data)
+
+	@property
+	def issuer(self):
+		return formatName(self.decoded.issuer)
+
+	@property
+	def serial(self):
+		return self.decoded.serial_number
+
+	# Validity period, as timezone aware datetime objects in UTC
+	@property
+	def notBefore(self):
+		return self.utcTime("not_valid_before")
+
+	@property
+	def notAfter(self):
+		return self.utcTime("not_valid_after")
+
+	# cryptography < 42 only has the naive datetime attributes
+	def utcTime(self, attr):
+		value = getattr(self.decoded, attr + "_utc", None)
+		if value is None:
+			value = getattr(self.decoded, attr).replace(tzinfo = datetime.timezone.utc)
+		return value
+
+	# Returns True if the certificate is valid at the given time (now by default),
+	# and will remain valid for at least minRemaining seconds.
+	def isValid(self, now = None, minRemaining = 0):
+		if now is None:
+			now = time.time()
+		return self.notBefore.timestamp() <= now and \
+		       now + minRemaining <= self.notAfter.timestamp()
 
 	@property
 	def blob(self):
-		with open(self.path, "rb") as f:
-			return f.read()
+		return self.data
+
+	# SHA256 fingerprint of the DER encoded certificate, as displayed
+	# by openssl x509 -fingerprint -sha256 (minus the colons)
+	@property
+	def fingerprint(self):
+		return hashlib.sha256(pemToDER(self.blob)).hexdigest()
+
+def pemToDER(blob):
+	body = None
+	for line in blob.decode('utf-8').splitlines():
+		if line.startswith("-----BEGIN "):
+			body = []
+		elif line.startswith("-----END "):
+			break
+		elif body is not None:
+			body.append(line)
+
+	if not body:
+		raise ValueError("Unable to find PEM encoded data")
+	return base64.b64decode("".join(body))
 
 class CA:
 	def __init__(self, pki, directory, cn):
@@ -162,6 +436,7 @@ class CA:
 		self.cn = cn
 		self.key = None
 		self.cert = None
+		self.cache = None
 
 		if not os.path.isdir(directory):
 			os.makedirs(directory, 0o755)
@@ -178,14 +453,930 @@ class Server:
 		self.key = None
 		self.cert = None
 
+		# Set by PKI.createWebServers if issuing failed
+		self.error = None
+
+##################################################################
+# Cache of issued certificates
+#
+# Entries are addressed by the CA's fingerprint and a digest of the
+# CertificateParameters, and live in a subdirectory of the CA, eg
+#
+#  FancyCA/cache/<hash>/cert.key
+#  FancyCA/cache/<hash>/cert.pem
+#  FancyCA/cache/<hash>/meta.json
+#
+# Entries are dropped when the certificate is about to expire, when
+# the CA changes, when they have not been used for maxAge seconds,
+# or (least recently used first) when there are more than maxEntries.
+#
+# The worker processes of PKI.createWebServers all use the same cache,
+# so lookups and updates are done while holding a lock on it.
+##################################################################
+class CertificateCache:
+	def __init__(self, ca, maxEntries = 256, maxAge = 7 * 86400, minRemaining = 86400):
+		self.ca = ca
+		self.directory = ca.getPathFor("cache")
+		self.maxEntries = maxEntries
+		self.maxAge = maxAge
+		self.minRemaining = minRemaining
+
+		self._caFingerprint = None
+
+	@property
+	def caFingerprint(self):
+		if self._caFingerprint is None:
+			self._caFingerprint = self.ca.cert.fingerprint
+		return self._caFingerprint
+
+	def makeKey(self, params, keyAlgorithm, bits):
+		h = hashlib.sha256()
+		h.update(self.caFingerprint.encode('utf-8'))
+		h.update(params.digest.encode('utf-8'))
+		h.update(f"{keyAlgorithm}/{bits}".encode('utf-8'))
+		return h.hexdigest()
+
+	def entryPath(self, key, name):
+		return os.path.join(self.directory, key, name)
+
+	def readMeta(self, key):
+		try:
+			with open(self.entryPath(key, "meta.json")) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def isValid(self, meta, now = None):
+		if now is None:
+			now = time.time()
+
+		if meta is None or meta.get("ca") != self.caFingerprint:
+			return False
+		if meta.get("notAfter", 0) - self.minRemaining < now:
+			return False
+		if meta.get("lastUsed", 0) + self.maxAge < now:
+			return False
+		return True
+
+	# Returns the lock file; the lock is released when it is closed
+	def lock(self):
+		os.makedirs(self.directory, 0o755, exist_ok = True)
+
+		f = open(self.directory + ".lock", "w")
+		fcntl.flock(f, fcntl.LOCK_EX)
+		return f
+
+	def lookup(self, params, keyAlgorithm, bits, keyPath, certPath):
+		key = self.makeKey(params, keyAlgorithm, bits)
+
+		with self.lock():
+			return self.lookupLocked(key, keyPath, certPath)
+
+	def lookupLocked(self, key, keyPath, certPath):
+		meta = self.readMeta(key)
+		if meta is None:
+			return False
+		if not self.isValid(meta):
+			self.drop(key)
+			return False
+
+		try:
+			shutil.copy(self.entryPath(key, "cert.key"), keyPath)
+			shutil.copy(self.entryPath(key, "cert.pem"), certPath)
+		except OSError:
+			# Someone else dropped the entry under our feet
+			return False
+
+		meta["lastUsed"] = time.time()
+		try:
+			self.writeMeta(key, meta)
+		except OSError:
+			pass
+		return True
+
+	def store(self, params, bits, server):
+		key = self.makeKey(params, server.key.algorithm, bits)
+
+		# Build the entry in a temporary directory and rename it into
+		# place, so that nobody ever sees an entry without meta.json
+		os.makedirs(self.directory, 0o755, exist_ok = True)
+		tmpdir = tempfile.mkdtemp(prefix = ".tmp-", dir = self.directory)
+		os.chmod(tmpdir, 0o755)
+
+		writeFile(os.path.join(tmpdir, "cert.key"), server.key.data, Key.file_mode)
+		writeFile(os.path.join(tmpdir, "cert.pem"), server.cert.data, Certificate.file_mode)
+
+		now = time.time()
+		if x509 is not None:
+			notAfter = server.cert.notAfter.timestamp()
+		else:
+			notAfter = now + 86400 * (params.validity or CryptographyBackend.defaultValidity)
+
+		self.writeMetaFile(os.path.join(tmpdir, "meta.json"), {
+			"ca":		self.caFingerprint,
+			"subject":	params.subject,
+			"created":	now,
+			"lastUsed":	now,
+			"notAfter":	notAfter,
+		})
+
+		with self.lock():
+			# Replace a stale entry, if there is one
+			self.drop(key)
+			try:
+				os.rename(tmpdir, os.path.join(self.directory, key))
+			except OSError:
+				shutil.rmtree(tmpdir, ignore_errors = True)
+
+			self.expire()
+
+	def writeMeta(self, key, meta):
+		self.writeMetaFile(self.entryPath(key, "meta.json"), meta)
+
+	def writeMetaFile(self, path, meta):
+		with open(path + ".tmp", "w") as f:
+			json.dump(meta, f)
+		os.rename(path + ".tmp", path)
+
+	def drop(self, key):
+		shutil.rmtree(os.path.join(self.directory, key), ignore_errors = True)
+
+	def expire(self):
+		now = time.time()
+
+		entries = []
+		for key in os.listdir(self.directory):
+			# Skip entries that are still being built, and the ones
+			# we cannot read
+			if key.startswith("."):
+				continue
+
+			meta = self.readMeta(key)
+			if meta is None:
+				continue
+
+			if not self.isValid(meta, now):
+				self.drop(key)
+			else:
+				entries.append((meta["lastUsed"], key))
+
+		entries.sort()
+		while len(entries) > self.maxEntries:
+			lastUsed, key = entries.pop(0)
+			self.drop(key)
+
+##################################################################
+# PKI backends
+#
+# A backend does the actual work of generating keys, and of
+# creating and signing certificates. The PKI class takes care of
+# the bookkeeping (paths, Key/CSR/Certificate objects, logging).
+#
+# All backend methods return True on success, False otherwise.
+##################################################################
+class OpenSSLBackend:
+	name = "openssl"
+
+	def __init__(self, pki):
+		self.pki = pki
+
+	# In pipe mode, openssl reads in-memory objects and config data through
+	# anonymous in-memory files, and writes its output to stdout. This is
+	# only possible when running openssl locally.
+	@property
+	def usePipes(self):
+		return self.pki.usePipes and self.pki.command is None
+
+	def run(self, *args, **kwargs):
+		return self.pki.run(*args, **kwargs)
+
+	# Run an openssl subcommand that produces the object "out"
+	def runOutput(self, args, out, inputs = [], input = None):
+		if not self.usePipes:
+			args = args[:1] + ["-out", out.path] + args[1:]
+			ok = self.run(*args, input = input)
+			out.invalidate()
+			return ok
+
+		try:
+			data = self.pki.pipe(*args, input = input, fds = [f.fd for f in inputs])
+		finally:
+			for f in inputs:
+				f.close()
+
+		if data is None:
+			return False
+
+		out.data = data
+		return True
+
+	# Return a path name through which openssl can read the given object.
+	# Objects that exist on disk already are passed by name; everything
+	# else goes through an in-memory file when in pipe mode.
+	def inputPath(self, thing, inputs):
+		if thing.hasPath or not self.usePipes:
+			return thing.path
+		return self.memoryFile(thing.data, inputs)
+
+	def configPath(self, config, inputs, extensionsOnly = False):
+		if not self.usePipes:
+			if extensionsOnly:
+				return config.extensionPath
+			return config.path
+
+		if extensionsOnly:
+			return self.memoryFile(config.extensionText.encode('utf-8'), inputs)
+		return self.memoryFile(config.text.encode('utf-8'), inputs)
+
+	def memoryFile(self, data, inputs):
+		f = MemoryFile(data)
+		inputs.append(f)
+		return f.path
+
+	# Install an unencrypted PEM key (as produced by generateKeyPEM),
+	# wrapping it with key.passphrase if needed
+	def installPrivateKey(self, data, key):
+		if not key.passphrase:
+			key.data = data
+			return True
+
+		return self.runOutput(["pkey", "-aes256", "-passout", f"pass:{key.passphrase}"],
+				key, input = data)
+
+	def removePassphrase(self, keyIn, keyOut):
+		inputs = []
+
+		args = [keyIn.keyAlgorithm.command]
+		if keyIn.passphrase:
+			args += ["-passin", f"pass:{keyIn.passphrase}"]
+		args += ["-in", self.inputPath(keyIn, inputs)]
+
+		return self.runOutput(args, keyOut, inputs)
+
+	def generatePrivateKey(self, key, bits):
+		alg = key.keyAlgorithm
+		if alg.name == "rsa":
+			args = ["genrsa"]
+			if key.passphrase:
+				args += ["-aes256", "-passout", f"pass:{key.passphrase}"]
+			args.append(str(bits))
+		else:
+			args = ["genpkey"] + alg.genpkeyOptions(bits)
+			if key.passphrase:
+				args += ["-aes256", "-pass", f"pass:{key.passphrase}"]
+
+		return self.runOutput(args, key)
+
+	def allocateSerial(self, caCert):
+		return allocateSerial(caCert)
+
+	# Returns the digest option to use when signing with the given key
+	def digestArgs(self, key):
+		digest = key.keyAlgorithm.digest
+		if digest is None:
+			return []
+		return ["-" + digest]
+
+	def runReq(self, args, privateKey, certificateParams, out):
+		inputs = []
+
+		args = ["req"] + args + [
+			"-subj", certificateParams.subject,
+			"-key", self.inputPath(privateKey, inputs)]
+		if certificateParams.validity and "-x509" in args:
+			args += ["-days", str(certificateParams.validity)]
+		if privateKey.passphrase:
+			args += ["-passin", f"pass:{privateKey.passphrase}"]
+
+		config = certificateParams.generateConfig()
+
+		if False:
+			print("--- CONFIG FILE ---")
+			print(config.text, end = "")
+			print("--- END CONFIG FILE ---")
+
+		args += ["-config", self.configPath(config, inputs)]
+		for ext in config.extensions:
+			args += ["-extensions", ext]
+
+		return self.runOutput(args, out, inputs)
+
+	def createSelfSignedCert(self, certificateParams, privateKey, cert):
+		return self.runReq(["-new", "-x509"] + self.digestArgs(privateKey), privateKey, certificateParams, cert)
+
+	def createCSR(self, certificateParams, privateKey, req):
+		return self.runReq(["-new"] + self.digestArgs(privateKey), privateKey, certificateParams, req)
+
+	def signCSR(self, caCert, req, cert):
+		certificateParams = req.params
+		inputs = []
+
+		# Do not use -CAcreateserial here; it is not safe when issuing
+		# several certificates concurrently.
+		args = ["x509", "-req"] + self.digestArgs(caCert.privateKey) + [
+			"-CA", self.inputPath(caCert, inputs),
+			"-CAkey", self.inputPath(caCert.privateKey, inputs),
+			"-set_serial", "0x%X" % self.allocateSerial(caCert),
+			"-passin", f"pass:{caCert.privateKey.passphrase}"]
+		if certificateParams.validity:
+			args += ["-days", str(certificateParams.validity)]
+
+		config = certificateParams.generateConfig()
+		if config.extensions:
+			args += ["-extfile", self.configPath(config, inputs, extensionsOnly = True)]
+			for ext in config.extensions:
+				args += ["-extensions", ext]
+
+		args += ["-in", self.inputPath(req, inputs)]
+
+		return self.runOutput(args, cert, inputs)
+
+# This backend does not run anything; it records the openssl commands
+# in a shell script that can be executed elsewhere in one go.
+# All objects passed to it must have path names relative to the
+# directory the script runs in.
+class ScriptBackend(OpenSSLBackend):
+	name = "script"
+
+	def __init__(self, pki):
+		super().__init__(pki)
+		self.commands = []
+		self.numFiles = 0
+
+	@property
+	def usePipes(self):
+		return False
+
+	@property
+	def text(self):
+		return "".join(cmd + "\n" for cmd in self.commands)
+
+	def run(self, *args, input = None):
+		cmd = " ".join(shlex.quote(arg) for arg in ["openssl"] + list(args))
+		if input is not None:
+			cmd = self.heredoc("base64 -d", input, pipeTo = cmd)
+		self.commands.append(cmd)
+		return True
+
+	def heredoc(self, command, data, pipeTo = None):
+		if pipeTo:
+			command += " <<'EOF' | " + pipeTo
+		else:
+			command += " <<'EOF'"
+		return command + "\n" + base64.encodebytes(data).decode('utf-8') + "EOF"
+
+	def mkdir(self, path):
+		self.commands.append(f"mkdir -p {shlex.quote(path)}")
+
+	def addFile(self, data, path = None):
+		if path is None:
+			self.numFiles += 1
+			path = f"tmp/input{self.numFiles}"
+		self.commands.append(self.heredoc(f"base64 -d > {shlex.quote(path)}", data))
+		return path
+
+	def configPath(self, config, inputs, extensionsOnly = False):
+		if extensionsOnly:
+			return self.addFile(config.extensionText.encode('utf-8'))
+		return self.addFile(config.text.encode('utf-8'))
+
+	# Serial numbers are allocated from the CA's serial file in our
+	# local workspace
+	def allocateSerial(self, caCert):
+		return allocateSerial(Certificate(os.path.join(self.pki.workspace, caCert.path)))
+
+# In-process backend based on the python cryptography package.
+# It produces the same PEM data as the openssl backend, so that the
+# two can be used interchangeably, even on the same workspace.
+class CryptographyBackend:
+	name = "cryptography"
+
+	# openssl's default when no -days option is given
+	defaultValidity = 30
+
+	subjectAttributes = {
+		"C":		"COUNTRY_NAME",
+		"ST":		"STATE_OR_PROVINCE_NAME",
+		"L":		"LOCALITY_NAME",
+		"O":		"ORGANIZATION_NAME",
+		"OU":		"ORGANIZATIONAL_UNIT_NAME",
+		"CN":		"COMMON_NAME",
+		"emailAddress":	"EMAIL_ADDRESS",
+	}
+
+	extendedKeyUsages = {
+		"serverAuth":		"SERVER_AUTH",
+		"clientAuth":		"CLIENT_AUTH",
+		"codeSigning":		"CODE_SIGNING",
+		"emailProtection":	"EMAIL_PROTECTION",
+		"timeStamping":		"TIME_STAMPING",
+		"OCSPSigning":		"OCSP_SIGNING",
+	}
+
+	def __init__(self, pki):
+		if x509 is None:
+			raise ImportError("The cryptography backend requires the python cryptography package")
+		self.pki = pki
+
+	def loadPrivateKey(self, key):
+		password = None
+		if key.passphrase:
+			password = key.passphrase.encode('utf-8')
+		return serialization.load_pem_private_key(key.data, password)
+
+	def writePrivateKey(self, privateKey, key):
+		if key.passphrase:
+			encryption = serialization.BestAvailableEncryption(key.passphrase.encode('utf-8'))
+		else:
+			encryption = serialization.NoEncryption()
+
+		key.data = privateKey.private_bytes(
+				encoding = serialization.Encoding.PEM,
+				format = serialization.PrivateFormat.PKCS8,
+				encryption_algorithm = encryption)
+
+	def loadCertificate(self, cert):
+		return x509.load_pem_x509_certificate(cert.data)
+
+	def writeCertificate(self, x509Cert, cert):
+		cert.data = x509Cert.public_bytes(serialization.Encoding.PEM)
+
+	def buildSubject(self, subject):
+		attrs = []
+		for rdn in subject.split('/'):
+			if not rdn:
+				continue
+			type, value = rdn.split('=', 1)
+			oid = self.subjectAttributes.get(type)
+			if oid is None:
+				raise ValueError(f"Unsupported attribute {type} in subject {subject}")
+			attrs.append(x509.NameAttribute(getattr(NameOID, oid), value))
+		return x509.Name(attrs)
+
+	def buildExtensions(self, certificateParams):
+		# When given several -extensions options, openssl only applies the
+		# last one. For a CA, this is the CA section, so mimic that in order
+		# to produce the same certificates as the openssl backend.
+		if certificateParams.CA:
+			return [(x509.BasicConstraints(ca = True, path_length = None), False)]
+
+		result = []
+		if certificateParams.altSubjectNames:
+			names = []
+			for san in certificateParams.altSubjectNames:
+				type, name = san.split(':', 1)
+				assert(type == 'DNS')
+				names.append(x509.DNSName(name))
+			result.append((x509.SubjectAlternativeName(names), False))
+
+		if certificateParams.extendedKeyUsage:
+			critical = False
+			usages = []
+			for word in certificateParams.extendedKeyUsage.split(','):
+				word = word.strip()
+				if word == "critical":
+					critical = True
+					continue
+				oid = self.extendedKeyUsages.get(word)
+				if oid is None:
+					raise ValueError(f"Unsupported extendedKeyUsage {word}")
+				usages.append(getattr(ExtendedKeyUsageOID, oid))
+			result.append((x509.ExtendedKeyUsage(usages), critical))
+
+		return result
+
+	def buildCertificate(self, certificateParams, subject, publicKey, issuer, signingKey, serial, issuerPublicKey = None):
+		notBefore = datetime.datetime.now(datetime.timezone.utc)
+		notAfter = notBefore + datetime.timedelta(days = certificateParams.validity or self.defaultValidity)
+
+		builder = x509.CertificateBuilder() \
+				.subject_name(subject) \
+				.issuer_name(issuer) \
+				.public_key(publicKey) \
+				.serial_number(serial) \
+				.not_valid_before(notBefore) \
+				.not_valid_after(notAfter)
+
+		for ext, critical in self.buildExtensions(certificateParams):
+			builder = builder.add_extension(ext, critical = critical)
+
+		builder = builder.add_extension(x509.SubjectKeyIdentifier.from_public_key(publicKey), critical = False)
+		if issuerPublicKey is not None:
+			builder = builder.add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(issuerPublicKey), critical = False)
+
+		return builder.sign(signingKey, self.signatureHash(signingKey))
+
+	@staticmethod
+	def signatureHash(privateKey):
+		# EdDSA keys do not take a separate digest
+		if isinstance(privateKey, ed25519.Ed25519PrivateKey):
+			return None
+		return hashes.SHA256()
+
+	@staticmethod
+	def newPrivateKey(algorithm, bits):
+		alg = getKeyAlgorithm(algorithm)
+		if alg.name == "rsa":
+			return rsa.generate_private_key(public_exponent = 65537, key_size = bits)
+		if alg.name == "ed25519":
+			return ed25519.Ed25519PrivateKey.generate()
+		return ec.generate_private_key(getattr(ec, alg.curve)())
+
+	def installPrivateKey(self, data, key):
+		self.writePrivateKey(serialization.load_pem_private_key(data, None), key)
+		return True
+
+	def removePassphrase(self, keyIn, keyOut):
+		self.writePrivateKey(self.loadPrivateKey(keyIn), keyOut)
+		return True
+
+	def generatePrivateKey(self, key, bits):
+		privateKey = self.newPrivateKey(key.algorithm, bits)
+		self.writePrivateKey(privateKey, key)
+		return True
+
+	def createSelfSignedCert(self, certificateParams, privateKey, cert):
+		signingKey = self.loadPrivateKey(privateKey)
+		subject = self.buildSubject(certificateParams.subject)
+
+		x509Cert = self.buildCertificate(certificateParams,
+				subject, signingKey.public_key(),
+				subject, signingKey,
+				x509.random_serial_number())
+		self.writeCertificate(x509Cert, cert)
+		return True
+
+	def createCSR(self, certificateParams, privateKey, req):
+		# Just like openssl req -new -extensions, we do not put
+		# any extensions into the CSR itself; they're added when signing.
+		signingKey = self.loadPrivateKey(privateKey)
+		x509Req = x509.CertificateSigningRequestBuilder() \
+				.subject_name(self.buildSubject(certificateParams.subject)) \
+				.sign(signingKey, self.signatureHash(signingKey))
+
+		req.data = x509Req.public_bytes(serialization.Encoding.PEM)
+		return True
+
+	def signCSR(self, caCert, req, cert):
+		x509Req = x509.load_pem_x509_csr(req.data)
+		if not x509Req.is_signature_valid:
+			twopence.error(f"Bad self-signature on certificate request for {req.params.subject}")
+			return False
+
+		x509CA = self.loadCertificate(caCert)
+		caKey = self.loadPrivateKey(caCert.privateKey)
+
+		x509Cert = self.buildCertificate(req.params,
+				x509Req.subject, x509Req.public_key(),
+				x509CA.subject, caKey,
+				allocateSerial(caCert),
+				issuerPublicKey = caKey.public_key())
+		self.writeCertificate(x509Cert, cert)
+		return True
+
+def writeFile(path, data, mode = 0o644):
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+	with os.fdopen(fd, "wb") as f:
+		f.write(data)
+
+# An anonymous in-memory file (see memfd_create(2)) that a subprocess
+# can open as /dev/fd/N
+class MemoryFile:
+	def __init__(self, data):
+		self.fd = os.memfd_create("pki")
+
+		view = memoryview(data)
+		while view:
+			view = view[os.write(self.fd, view):]
+
+	@property
+	def path(self):
+		return f"/dev/fd/{self.fd}"
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+# Allocate the next serial number for a certificate signed by caCert.
+# This uses the same file as openssl x509 -CAcreateserial (ie ca.srl
+# next to ca.cert), but holds a lock while updating it, so that it is
+# safe to use from several processes at the same time.
+def allocateSerial(caCert):
+	path = os.path.splitext(caCert.path)[0] + ".srl"
+
+	with open(path + ".lock", "w") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+
+		if os.path.exists(path):
+			with open(path) as f:
+				serial = int(f.read().strip(), 16) + 1
+		else:
+			# Same as openssl: 159 random bits
+			serial = int.from_bytes(os.urandom(20), "big") >> 1
+
+		hex = "%X" % serial
+		if len(hex) % 2:
+			hex = "0" + hex
+
+		writeFile(path + ".tmp", (hex + "\n").encode('utf-8'))
+		os.rename(path + ".tmp", path)
+
+	return serial
+
+# Generate an unencrypted private key and return it as PKCS8 PEM.
+# This is what the KeyPool worker processes execute.
+def generateKeyPEM(algorithm, bits):
+	if x509 is not None:
+		privateKey = CryptographyBackend.newPrivateKey(algorithm, bits)
+		return privateKey.private_bytes(
+				encoding = serialization.Encoding.PEM,
+				format = serialization.PrivateFormat.PKCS8,
+				encryption_algorithm = serialization.NoEncryption())
+
+	alg = getKeyAlgorithm(algorithm)
+	return subprocess.check_output(["openssl", "genpkey"] + alg.genpkeyOptions(bits))
+
+##################################################################
+# Pool of pre-generated keys
+#
+# Key generation is the single most expensive step when issuing
+# a certificate. The pool keeps up to <size> keys ready for every
+# (algorithm, bits) pair it has been asked for, and generates them
+# in a set of worker processes.
+#
+# Keys are generated without a passphrase; when handing out a key,
+# the backend wraps it with the caller's passphrase, if any.
+##################################################################
+class KeyPool:
+	def __init__(self, pki, size = 4, workers = None):
+		self.pki = pki
+		self.size = size
+		self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = workers)
+		self.lock = threading.Lock()
+		self.pending = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.refills = 0
+		self.refillTime = 0
+		self.refillTimeMax = 0
+
+	def prime(self, algorithm = "rsa", bits = 2048):
+		queue = self.pending.setdefault((algorithm, bits), [])
+		while len(queue) < self.size:
+			queue.append(self.submit(algorithm, bits))
+
+	def submit(self, algorithm, bits):
+		started = time.monotonic()
+
+		def refillDone(future):
+			elapsed = time.monotonic() - started
+			with self.lock:
+				self.refills += 1
+				self.refillTime += elapsed
+				self.refillTimeMax = max(self.refillTimeMax, elapsed)
+
+		future = self.executor.submit(generateKeyPEM, algorithm, bits)
+		future.add_done_callback(refillDone)
+		return future
+
+	# Take a key from the pool and install it as key.path.
+	# If no key is ready, we wait for the one that's been in the
+	# works for the longest time.
+	def take(self, key, algorithm = "rsa", bits = 2048):
+		self.prime(algorithm, bits)
+
+		queue = self.pending[(algorithm, bits)]
+		future = next((f for f in queue if f.done()), None)
+		if future is not None:
+			self.hits += 1
+		else:
+			self.misses += 1
+			future = queue[0]
+		queue.remove(future)
+
+		# Kick off the replacement right away
+		self.prime(algorithm, bits)
+
+		try:
+			data = future.result()
+		except Exception as e:
+			twopence.error(f"Key pool failed to generate {algorithm} key: {e}")
+			return False
+
+		return self.pki.backend.installPrivateKey(data, key)
+
+	@property
+	def refillLatency(self):
+		if not self.refills:
+			return 0
+		return self.refillTime / self.refills
+
+	def summary(self):
+		return f"{self.hits} hits, {self.misses} misses, {self.refills} refills, " \
+		       f"refill latency avg {self.refillLatency:.3f}s max {self.refillTimeMax:.3f}s"
+
+	def close(self):
+		self.executor.shutdown(wait = False, cancel_futures = True)
+		self.pending = {}
+
+##################################################################
+# Operation statistics
+#
+# For each instrumented PKI operation, we record the number of calls
+# and failures, the wall clock time spent, how much of that was spent
+# waiting for openssl (or the target), and the number of bytes of keys,
+# certificates etc produced.
+#
+# Operations nest (createWebServer calls generatePrivateKey, which may
+# call run), and the numbers are inclusive; so subprocess time spent in
+# a run() call issued by signCSR is accounted to run, signCSR and
+# createWebServer.
+##################################################################
+class OperationStats:
+	def __init__(self, name):
+		self.name = name
+		self.calls = 0
+		self.failures = 0
+		self.wallTime = 0
+		self.maxTime = 0
+		self.subprocessTime = 0
+		self.bytesWritten = 0
+
+	def asDict(self):
+		return {
+			"calls":		self.calls,
+			"failures":		self.failures,
+			"wallTime":		round(self.wallTime, 6),
+			"maxTime":		round(self.maxTime, 6),
+			"subprocessTime":	round(self.subprocessTime, 6),
+			"bytesWritten":		self.bytesWritten,
+		}
+
+class PKIStats:
+	def __init__(self):
+		self.operations = {}
+		self.active = []
+
+	def get(self, name):
+		op = self.operations.get(name)
+		if op is None:
+			op = OperationStats(name)
+			self.operations[name] = op
+		return op
+
+	def begin(self, name):
+		op = self.get(name)
+		op.calls += 1
+		self.active.append(op)
+		return op
+
+	def end(self, op, elapsed, ok = True, bytesWritten = 0):
+		assert(self.active and self.active[-1] is op)
+		self.active.pop()
+
+		op.wallTime += elapsed
+		op.maxTime = max(op.maxTime, elapsed)
+		if not ok:
+			op.failures += 1
+
+		# Count the artifact only once per nesting level
+		if op not in self.active:
+			op.bytesWritten += bytesWritten
+
+	# Subprocess time is accounted to all active operations
+	def addSubprocessTime(self, elapsed):
+		for op in set(self.active):
+			op.subprocessTime += elapsed
+
+	def asDict(self):
+		return dict((name, op.asDict()) for name, op in sorted(self.operations.items()))
+
+	def json(self):
+		return json.dumps(self.asDict(), indent = 2)
+
+	def summary(self):
+		lines = []
+		for name, op in sorted(self.operations.items()):
+			lines.append(f"{name:24} {op.calls:5} calls, {op.failures} failed, " \
+				     f"{op.wallTime:8.3f}s total, {op.subprocessTime:8.3f}s in subprocesses, " \
+				     f"{op.bytesWritten} bytes written")
+		return lines
+
+# Return the number of bytes of the objects created by an operation
+def artifactSize(thing):
+	if isinstance(thing, (list, tuple)):
+		return sum(artifactSize(t) for t in thing)
+	if isinstance(thing, (bytes, bytearray)):
+		return len(thing)
+	if isinstance(thing, FileBackedThing):
+		return len(thing.data or b'')
+	if isinstance(thing, (CA, Server)):
+		return artifactSize(thing.key) + artifactSize(thing.cert)
+	return 0
+
+# An operation is considered to have failed if it returns None or False,
+# or a Server/CA object without certificate
+def succeeded(result):
+	if result is None or result is False:
+		return False
+	if isinstance(result, tuple):
+		return bool(result) and succeeded(result[0])
+	if isinstance(result, (CA, Server)):
+		return result.cert is not None
+	return True
+
+# Decorator for PKI methods that records an operation in self.stats
+def instrumented(name):
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self, *args, **kwargs):
+			op = self.stats.begin(name)
+			t0 = time.monotonic()
+			result = None
+			try:
+				result = func(self, *args, **kwargs)
+			finally:
+				self.stats.end(op, time.monotonic() - t0, succeeded(result), artifactSize(result))
+			return result
+		return wrapper
+	return decorator
+
+# Issue a single web server identity. This is what the worker processes
+# of PKI.createWebServers execute; it returns the paths of the key and
+# certificate.
+def issueWebServer(settings, caDirectory, caName, caPassphrase, caKeyAlgorithm, hostname, aliases, keyAlgorithm):
+	pki = PKI(**settings)
+
+	ca = pki.createCA(caName, caDirectory, caPassphrase, keyAlgorithm = caKeyAlgorithm)
+	if ca.cert is None:
+		raise ValueError(f"Unable to load CA {caName} from {caDirectory}")
+
+	server = pki.createWebServer(ca, hostname, aliases, keyAlgorithm = keyAlgorithm)
+	if server.key is None or server.cert is None:
+		raise ValueError(f"Failed to issue certificate for {hostname}")
+
+	return server.key.path, server.cert.path
+
 class PKI:
-	def __init__(self, workspace = None, timeout = 10):
+	backends = {
+		OpenSSLBackend.name:		OpenSSLBackend,
+		CryptographyBackend.name:	CryptographyBackend,
+	}
+
+	# If backend is not specified, we use the in-process backend if the
+	# cryptography package is available, and fall back to forking openssl
+	# otherwise.
+	def __init__(self, workspace = None, timeout = 10, backend = None, cache = True, keyPool = 0, pipes = True):
 		self.workspace = workspace
 		self.path = "openssl"
 		self.timeout = timeout
 		self.command = None
 		self.target = None
 
+		# Counters and timings, see class PKIStats
+		self.stats = PKIStats()
+
+		# If enabled, createWebServer will reuse previously issued
+		# certificates, see class CertificateCache
+		self.useCache = cache
+
+		# If enabled, the openssl backend passes intermediate objects
+		# through pipes and in-memory files rather than temp files
+		self.usePipes = pipes
+
+		if backend is None:
+			backend = (x509 is not None) and CryptographyBackend.name or OpenSSLBackend.name
+		self.setBackend(backend)
+
+		# If requested, keep a number of RSA keys ready for use
+		self.keyPool = None
+		if keyPool:
+			self.enableKeyPool(keyPool)
+
+	def enableKeyPool(self, size = 4, workers = None):
+		if self.keyPool is None:
+			self.keyPool = KeyPool(self, size, workers)
+			self.keyPool.prime()
+		return self.keyPool
+
+	def close(self):
+		for line in self.stats.summary():
+			twopence.info(f"PKI stats: {line}")
+
+		if self.keyPool is not None:
+			twopence.info(f"Key pool stats: {self.keyPool.summary()}")
+			self.keyPool.close()
+			self.keyPool = None
+
+	def setBackend(self, name):
+		klass = self.backends.get(name)
+		if klass is None:
+			raise ValueError(f"Unknown PKI backend \"{name}\"")
+
+		self.backend = klass(self)
+
 	# If we're configuring a containerized application, we will be using
 	# a local config directory that is mounted into the container at
 	# runtime. In this case, we do not need openssl in the container,
@@ -197,15 +1388,37 @@ class PKI:
 		# self.command = target.requireExecutable("openssl")
 		self.target = target
 
-	def run(self, *args):
-		if self.command is not None:
-			st = self.command.run(*args, timeout = self.timeout)
-			return bool(st)
-
+	@instrumented("run")
+	def run(self, *args, input = None):
+		t0 = time.monotonic()
+		try:
+			if self.command is not None:
+				st = self.command.run(*args, stdin = input, timeout = self.timeout)
+				return bool(st)
+
+			twopence.debug(f"  About to run {' '.join(args)}")
+			cmd = subprocess.Popen([self.path] + list(args),
+					stdin = input is not None and subprocess.PIPE or None)
+			cmd.communicate(input = input, timeout = self.timeout)
+			return cmd.returncode == 0
+		finally:
+			self.stats.addSubprocessTime(time.monotonic() - t0)
+
+	# Run openssl locally, passing the given file descriptors to it,
+	# and return its standard output (or None on failure)
+	@instrumented("run")
+	def pipe(self, *args, input = None, fds = ()):
 		twopence.debug(f"  About to run {' '.join(args)}")
-		cmd = subprocess.Popen([self.path] + list(args))
-		cmd.communicate(timeout = self.timeout)
-		return cmd.returncode == 0
+		t0 = time.monotonic()
+		cmd = subprocess.Popen([self.path] + list(args),
+				stdin = input is not None and subprocess.PIPE or None,
+				stdout = subprocess.PIPE,
+				pass_fds = fds)
+		data, _ = cmd.communicate(input = input, timeout = self.timeout)
+		self.stats.addSubprocessTime(time.monotonic() - t0)
+		if cmd.returncode != 0:
+			return None
+		return data
 
 	def readCertificate(self, path):
 		if self.target is not None:
@@ -224,28 +1437,26 @@ class PKI:
 
 	def removePassphrase(self, keyIn, outKeyPath):
 		twopence.info(f"::: Removing passphrase from key, storing result in {outKeyPath}")
-		args = ["rsa"]
 
-		if keyIn.passphrase:
-			args += ["-passin", f"pass:{keyIn.passphrase}"]
-
-		args += ["-in", keyIn.path, "-out", outKeyPath]
-		if not self.run(*args):
+		key = Key(outKeyPath, algorithm = keyIn.algorithm)
+		if not self.backend.removePassphrase(keyIn, key):
 			twopence.error(f"Failed to remove passphrase from key {keyIn.path}")
 			return None
 
-		return Key(outKeyPath)
+		return key
 
-	def generatePrivateKey(self, keyPath = None, passphrase = None, bits = 2048):
-		key = Key(path = keyPath, passphrase = passphrase)
+	# bits is only used for RSA keys
+	@instrumented("generatePrivateKey")
+	def generatePrivateKey(self, keyPath = None, passphrase = None, bits = 2048, algorithm = "rsa"):
+		key = Key(path = keyPath, passphrase = passphrase, algorithm = algorithm)
 
-		args = ["genrsa"]
-		if passphrase:
-			args += ["-aes256", "-passout", f"pass:{key.passphrase}"]
-		args += ["-out", key.path, str(bits)]
+		if self.keyPool is not None:
+			ok = self.keyPool.take(key, key.algorithm, bits)
+		else:
+			ok = self.backend.generatePrivateKey(key, bits)
 
-		if not self.run(*args):
-			twopence.error(f"Failed to generate RSA key {key.path}")
+		if not ok:
+			twopence.error(f"Failed to generate {key.algorithm} key {key.path}")
 			return None
 
 		return key
@@ -253,108 +1464,74 @@ class PKI:
 	def parametersForSSLServer(self, hostname, validity = 365):
 		return CertificateParameters(f"/CN={hostname}", extendedKeyUsage = "serverAuth")
 
+	def parametersForWebServer(self, hostname, aliases = []):
+		params = self.parametersForSSLServer(hostname)
+		params.addAltSubjectName("dns", hostname)
+		for alias in aliases:
+			params.addAltSubjectName("dns", alias)
+		return params
+
 	def parametersForCA(self, caName, validity = 365):
 		return CertificateParameters(f"/CN={caName}", extendedKeyUsage = "critical, keyCertSign", CA = True)
 
-	def runReq(self, args, privateKey, certificateParams, outPath):
-		args = ["req"] + args + [
-			"-subj", certificateParams.subject,
-			"-key", privateKey.path]
-		if certificateParams.validity and "-x509" in args:
-			args += ["-days", str(certificateParams.validity)]
-		if privateKey.passphrase:
-			args += ["-passin", f"pass:{privateKey.passphrase}"]
-		args += ["-out", outPath]
-
-		config = certificateParams.generateConfig()
-
-		if False:
-			print("--- CONFIG FILE ---")
-			with open(config.path) as f:
-				print(f.read())
-			print("--- END CONFIG FILE ---")
-
-		args += ["-config", config.path]
-		for ext in config.extensions:
-			args += ["-extensions", ext]
-
-		return self.run(*args)
-
+	@instrumented("createSelfSignedCert")
 	def createSelfSignedCert(self, certificateParams, privateKey, outPath = None):
 		twopence.info(f"::: Creating Self-signed Certificate {certificateParams.subject}")
 		cert = Certificate(path = outPath, privateKey = privateKey)
 
-		if not self.runReq(["-new", "-x509", "-sha256"], privateKey, certificateParams, cert.path):
+		if not self.backend.createSelfSignedCert(certificateParams, privateKey, cert):
 			twopence.error(f"Failed to create certificate {cert.path}")
 			return None
 
 		return cert
 
+	@instrumented("createCSR")
 	def createCSR(self, certificateParams, privateKey, outPath = None):
 		twopence.info(f"::: Creating Certificate Signing Request for {certificateParams.subject}")
 
 		req = CSR(path = outPath, params = certificateParams, privateKey = privateKey)
 
-		if not self.runReq(["-new", "-sha256"], privateKey, certificateParams, req.path):
+		if not self.backend.createCSR(certificateParams, privateKey, req):
 			twopence.error(f"Failed to create certificate request {req.path}")
 			return None
 
 		return req
-		args = ["req", "-new", "-in", cert.path,
-			"-signkey", caKey.path, 
-			"-passin", f"pass:{caKey.passphrase}",
-			"-out", outPath]
-		if not self.run(*args):
-			return None
-
-		return req
 
+	@instrumented("signCSR")
 	def signCSR(self, caCert, req, outPath):
 		twopence.info(f"::: Signing Certificate {req.params.subject}")
 
 		cert = Certificate(path = outPath, privateKey = req.privateKey)
 
-		certificateParams = req.params
-
-		args = ["x509", "-req", "-sha256",
-			"-CA", caCert.path,
-			"-CAkey", caCert.privateKey.path,
-			"-CAcreateserial",
-			"-passin", f"pass:{caCert.privateKey.passphrase}"]
-		if certificateParams.validity:
-			args += ["-days", str(certificateParams.validity)]
-
-		config = certificateParams.generateConfig()
-		if config.extensions:
-			args += ["-extfile", config.extensionPath]
-			for ext in config.extensions:
-				args += ["-extensions", ext]
-
-		args += [
-			"-in", req.path,
-			"-out", cert.path
-			]
-
-		if not self.run(*args):
+		if not self.backend.signCSR(caCert, req, cert):
 			twopence.error(f"Failed to sign certificate request {req.path}")
 			return None
 
 		return cert
 
-	def createCA(self, cn, directory = None, passphrase = None):
+	# CAs using a key algorithm other than RSA live in a separate directory
+	# by default, so that we can have eg an RSA and an ECDSA FancyCA side by side
+	def defaultCADirectory(self, cn, keyAlgorithm = "rsa"):
+		assert(self.workspace)
+		directory = os.path.join(self.workspace, cn)
+		if keyAlgorithm != "rsa":
+			directory += f"-{keyAlgorithm}"
+		return directory
+
+	@instrumented("createCA")
+	def createCA(self, cn, directory = None, passphrase = None, keyAlgorithm = "rsa"):
 		twopence.info(f"::: Creating Certificate Authority {cn}")
 
 		if directory is None:
-			assert(self.workspace)
-			directory = os.path.join(self.workspace, cn)
+			directory = self.defaultCADirectory(cn, keyAlgorithm)
 
 		ca = CA(self, directory, cn)
 
 		path = os.path.join(directory, "ca.key")
 		if os.path.exists(path):
-			ca.key = Key(path, passphrase)
+			ca.key = Key(path, passphrase, algorithm = keyAlgorithm)
 		else:
-			ca.key = self.generatePrivateKey(path, passphrase)
+			ca.key = self.generatePrivateKey(path, passphrase, algorithm = keyAlgorithm)
 
 		path = os.path.join(directory, "ca.cert")
 		if os.path.exists(path):
@@ -365,29 +1542,329 @@ class PKI:
 
 		return ca
 
-	def createWebServer(self, ca, hostname, aliases = []):
+	# If keyAlgorithm is not given, use the same type of key as the CA
+	@instrumented("createWebServer")
+	def createWebServer(self, ca, hostname, aliases = [], keyAlgorithm = None, bits = 2048):
 		assert('/' not in hostname)
 		assert(not hostname.startswith('.'))
 
 		path = ca.getPathFor("webserver", hostname)
+		keyPath = os.path.join(path, "cert.key")
+		certPath = os.path.join(path, "cert.pem")
+
+		params = self.parametersForWebServer(hostname, aliases)
+
+		if keyAlgorithm is None:
+			keyAlgorithm = ca.key.algorithm
 
 		server = Server(hostname)
-		server.key = self.generatePrivateKey(os.path.join(path, "cert.key"))
 
-		params = self.parametersForSSLServer(hostname)
-		params.addAltSubjectName("dns", hostname)
-		for alias in aliases:
-			params.addAltSubjectName("dns", alias)
+		cache = self.getCertificateCache(ca)
+		if cache and cache.lookup(params, keyAlgorithm, bits, keyPath, certPath):
+			twopence.info(f"::: Reusing cached certificate for {params.subject}")
+			server.key = Key(keyPath, algorithm = keyAlgorithm)
+			server.cert = Certificate(certPath, server.key)
+			return server
+
+		server.key = self.generatePrivateKey(keyPath, bits = bits, algorithm = keyAlgorithm)
 
 		req = self.createCSR(params, server.key)
-		server.cert = self.signCSR(ca.cert, req, os.path.join(path, "cert.pem"))
+		server.cert = self.signCSR(ca.cert, req, certPath)
+
+		if cache and server.key and server.cert:
+			cache.store(params, bits, server)
 
 		return server
 
-if __name__ == '__main__':
-	pki = PKI("/tmp/pki")
+	# Issue certificates for many web servers at once, using a pool of
+	# worker processes. servers is a list of (hostname, aliases) tuples.
+	#
+	# This returns a list of Server objects, in the same order. If issuing
+	# a certificate failed, the Server object's key and cert are None, and
+	# its error member contains the reason.
+	@instrumented("createWebServers")
+	def createWebServers(self, ca, servers, workers = None, keyAlgorithm = None):
+		twopence.info(f"::: Issuing {len(servers)} web server certificates")
+
+		settings = {
+			"workspace":	self.workspace,
+			"timeout":	self.timeout,
+			"backend":	self.backend.name,
+			"cache":	self.useCache,
+		}
+
+		result = []
+		with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+			for hostname, aliases in servers:
+				future = executor.submit(issueWebServer, settings,
+						ca.directory, ca.cn, ca.key.passphrase, ca.key.algorithm,
+						hostname, list(aliases), keyAlgorithm)
+				result.append((Server(hostname), future))
+
+		failed = 0
+		for server, future in result:
+			try:
+				keyPath, certPath = future.result()
+			except Exception as e:
+				server.error = str(e) or e.__class__.__name__
+				twopence.error(f"Failed to issue certificate for {server.hostname}: {server.error}")
+				failed += 1
+				continue
+
+			server.key = Key(keyPath, algorithm = keyAlgorithm or ca.key.algorithm)
+			server.cert = Certificate(certPath, server.key)
+
+		if failed:
+			twopence.error(f"{failed} out of {len(servers)} certificates could not be issued")
+
+		return [server for server, future in result]
+
+	# Create (or reuse) a CA, and issue certificates for a list of web servers,
+	# doing all the work on the target set via configureTarget().
+	#
+	# Everything is compiled into a single shell script that runs in one
+	# remote command, and which returns all keys and certificates as a tar
+	# archive on its standard output. An existing CA is shipped to the target
+	# as part of the script. The results are unpacked into our workspace,
+	# using the same layout as createCA/createWebServer.
+	#
+	# Returns the CA object plus a list of Server objects.
+	@instrumented("createRemoteIdentities")
+	def createRemoteIdentities(self, cn, servers, passphrase = None, keyAlgorithm = "rsa", bits = 2048):
+		assert(self.target is not None)
+
+		twopence.info(f"::: Creating CA {cn} and {len(servers)} server identities on the target")
+
+		directory = self.defaultCADirectory(cn, keyAlgorithm)
+		caDir = os.path.relpath(directory, self.workspace)
+		os.makedirs(directory, 0o755, exist_ok = True)
+
+		script = ScriptBackend(self)
+		script.mkdir("tmp")
+		script.mkdir(caDir)
+
+		caKey = Key(os.path.join(caDir, "ca.key"), passphrase, algorithm = keyAlgorithm)
+		caCert = Certificate(os.path.join(caDir, "ca.cert"), caKey)
 
-	ca = pki.createCA("FancyCA", passphrase = "rand0mP4ssphr4se")
-	server = pki.createWebServer(ca, "foo.bar.com", aliases = ["foo2.bar.com"])
+		localKey = os.path.join(directory, "ca.key")
+		if os.path.exists(localKey):
+			script.addFile(Key(localKey).data, caKey.path)
+		else:
+			script.generatePrivateKey(caKey, bits)
+
+		localCert = os.path.join(directory, "ca.cert")
+		if os.path.exists(localCert):
+			script.addFile(Certificate(localCert).data, caCert.path)
+		else:
+			script.createSelfSignedCert(self.parametersForCA(cn), caKey, caCert)
+
+		for hostname, aliases in servers:
+			assert('/' not in hostname)
+			assert(not hostname.startswith('.'))
+
+			path = os.path.join(caDir, "webserver", hostname)
+			script.mkdir(path)
+
+			params = self.parametersForWebServer(hostname, aliases)
+			key = Key(os.path.join(path, "cert.key"), algorithm = keyAlgorithm)
+			req = CSR(f"tmp/{hostname}.csr", params, key)
+			cert = Certificate(os.path.join(path, "cert.pem"), key)
+
+			script.generatePrivateKey(key, bits)
+			script.createCSR(params, key, req)
+			script.signCSR(caCert, req, cert)
+
+		command = "set -e\n" + \
+			  "umask 077\n" + \
+			  "dir=$(mktemp -d)\n" + \
+			  "trap 'rm -rf \"$dir\"' EXIT\n" + \
+			  "cd \"$dir\"\n" + \
+			  script.text + \
+			  f"tar cf - {shlex.quote(caDir)} | base64\n"
+
+		# openssl writes its progress messages to stderr; keep them
+		# out of the base64 encoded archive
+		t0 = time.monotonic()
+		st = self.target.run("/bin/sh", stdin = command.encode('utf-8'),
+				stdout = bytearray(), stderr = bytearray(),
+				timeout = self.timeout * len(script.commands), quiet = True)
+		self.stats.addSubprocessTime(time.monotonic() - t0)
+		if not st:
+			twopence.error(f"Failed to create PKI on target: {st.message}")
+			if st.stderr:
+				twopence.error(bytes(st.stderr).decode('utf-8', errors = 'replace'))
+			return None, []
+
+		archive = tarfile.open(fileobj = io.BytesIO(base64.b64decode(st.stdout)))
+		if hasattr(tarfile, "data_filter"):
+			archive.extractall(self.workspace, filter = "data")
+		else:
+			archive.extractall(self.workspace)
+
+		# umask 077 made everything private; only the keys should be
+		for root, dirs, files in os.walk(directory):
+			for name in dirs:
+				os.chmod(os.path.join(root, name), 0o755)
+			for name in files:
+				if not name.endswith(".key"):
+					os.chmod(os.path.join(root, name), 0o644)
+
+		ca = self.createCA(cn, directory, passphrase, keyAlgorithm)
+
+		result = []
+		for hostname, aliases in servers:
+			path = ca.getPathFor("webserver", hostname)
+
+			server = Server(hostname)
+			server.key = Key(os.path.join(path, "cert.key"), algorithm = keyAlgorithm)
+			server.cert = Certificate(os.path.join(path, "cert.pem"), server.key)
+			result.append(server)
+
+		return ca, result
 
-	# pki.dump(server.cert)
+	def getCertificateCache(self, ca):
+		if not self.useCache:
+			return None
+
+		if ca.cache is None:
+			ca.cache = CertificateCache(ca)
+		return ca.cache
+
+##################################################################
+# Benchmarks
+#
+# Run this module with --benchmark to time the basic PKI operations
+# for each backend, eg
+#
+#  python3 openssl_pki.py --benchmark --iterations 20 --output bench.json
+#
+# For each case, the median and 95th percentile (in seconds) are reported
+# as JSON. Certificate caching and the key pool are disabled, so that we
+# measure the actual cost of each operation.
+##################################################################
+class Benchmark:
+	keyTypes = (
+		("rsa", 2048),
+		("rsa", 3072),
+		("rsa", 4096),
+		("ecdsa-p256", None),
+		("ecdsa-p384", None),
+		("ed25519", None),
+	)
+
+	def __init__(self, backend, workspace, iterations = 10, batchSizes = (1, 4, 16)):
+		self.backend = backend
+		self.workspace = workspace
+		self.iterations = iterations
+		self.batchSizes = batchSizes
+		self.results = {}
+		self.counter = 0
+
+		self.pki = PKI(workspace, backend = backend, cache = False, timeout = 120)
+
+	def uniquePath(self, name):
+		self.counter += 1
+		return os.path.join(self.workspace, f"{name}{self.counter}")
+
+	def measure(self, name, func, iterations = None):
+		samples = []
+		for i in range(iterations or self.iterations):
+			t0 = time.perf_counter()
+			result = func()
+			elapsed = time.perf_counter() - t0
+
+			if not succeeded(result):
+				raise ValueError(f"Benchmark {name}: operation failed")
+			samples.append(elapsed)
+
+		samples.sort()
+		self.results[name] = {
+			"samples":	len(samples),
+			"median":	round(percentile(samples, 50), 6),
+			"p95":		round(percentile(samples, 95), 6),
+			"min":		round(samples[0], 6),
+			"max":		round(samples[-1], 6),
+		}
+
+	def run(self):
+		pki = self.pki
+
+		self.measure("createCA",
+			lambda: pki.createCA("BenchCA", self.uniquePath("ca"), "bench"))
+
+		for algorithm, bits in self.keyTypes:
+			name = f"generatePrivateKey/{algorithm}"
+			if bits is not None:
+				name += f"-{bits}"
+			self.measure(name,
+				lambda: pki.generatePrivateKey(bits = bits or 2048, algorithm = algorithm))
+
+		ca = pki.createCA("BenchCA", self.uniquePath("ca"), "bench")
+		key = pki.generatePrivateKey()
+		params = pki.parametersForWebServer("bench.example.com", ["www.example.com"])
+
+		self.measure("createCSR", lambda: pki.createCSR(params, key))
+
+		req = pki.createCSR(params, key)
+		self.measure("signCSR", lambda: pki.signCSR(ca.cert, req, None))
+
+		for size in self.batchSizes:
+			self.measure(f"createWebServer/{size}",
+				lambda: [pki.createWebServer(ca, f"host{i}.example.com") for i in range(size)])
+
+			self.measure(f"createWebServers/{size}",
+				lambda: pki.createWebServers(ca, [(f"host{i}.example.com", []) for i in range(size)]),
+				iterations = max(1, self.iterations // 4))
+
+		return self.results
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description = "Create a test CA, or benchmark PKI operations")
+	parser.add_argument('--benchmark', default = False, action = 'store_true',
+			help = "Run the benchmarks rather than creating FancyCA")
+	parser.add_argument('--backend', action = 'append',
+			help = "Benchmark the given backend (may be given several times; default: all available)")
+	parser.add_argument('--iterations', type = int, default = 10,
+			help = "Number of samples per benchmark case")
+	parser.add_argument('--batch-sizes', default = "1,4,16",
+			help = "Comma separated list of batch sizes for the createWebServer benchmarks")
+	parser.add_argument('--output',
+			help = "Write the JSON results to this file rather than standard output")
+	opts = parser.parse_args()
+
+	if not opts.benchmark:
+		pki = PKI("/tmp/pki")
+
+		ca = pki.createCA("FancyCA", passphrase = "rand0mP4ssphr4se")
+		server = pki.createWebServer(ca, "foo.bar.com", aliases = ["foo2.bar.com"])
+
+		# pki.dump(server.cert)
+	else:
+		backends = opts.backend
+		if not backends:
+			backends = [OpenSSLBackend.name]
+			if x509 is not None:
+				backends.append(CryptographyBackend.name)
+
+		batchSizes = [int(n) for n in opts.batch_sizes.split(',')]
+
+		report = {
+			"created":	datetime.datetime.now(datetime.timezone.utc).isoformat(),
+			"iterations":	opts.iterations,
+			"results":	{},
+		}
+
+		for backend in backends:
+			with tempfile.TemporaryDirectory(prefix = "pki-bench-") as workspace:
+				bench = Benchmark(backend, workspace, opts.iterations, batchSizes)
+				report["results"][backend] = bench.run()
+				bench.pki.close()
+
+		data = json.dumps(report, indent = 2)
+		if opts.output:
+			with open(opts.output, "w") as f:
+				print(data, file = f)
+		else:
+			print(data)
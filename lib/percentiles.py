@@ -0,0 +1,14 @@
+##################################################################
+#
+# Percentile helpers shared by the test scripts and libraries.
+#
+# This module must not depend on twopence or susetest, so that
+# stand-alone tools such as the PKI benchmark in openssl_pki.py
+# can use it, too.
+#
+##################################################################
+
+# Nearest-rank percentile of a sorted, non-empty list
+def percentile(samples, pct):
+	index = max(0, -(-len(samples) * pct // 100) - 1)
+	return samples[int(index)]
@@ -0,0 +1,243 @@
+##################################################################
+#
+# Common code for the applications that install CA certificates
+# and make them trusted (suse_trustmgr, redhat_trustmgr).
+#
+# The platform differences are abstracted away by two resources,
+# the "trust-certificates" directory and the "update-certificate-trust"
+# executable.
+#
+# Copyright (C) 2022, Olaf Kirch <okir@suse.com>
+#
+##################################################################
+
+import collections
+import hashlib
+import twopence
+import base64
+import time
+import shlex
+import os
+
+from farthings.openssl_pki import pemToDER
+
+# Print the content hash of every file in the trust-certificates
+# directory, plus the fingerprint of the certificate it contains
+# (provided openssl is available)
+LIST_SCRIPT = '''
+cd "$1" || exit 1
+for f in *; do
+	test -f "$f" || continue
+	sha256sum < "$f" | cut -d' ' -f1
+	if command -v openssl >/dev/null 2>&1; then
+		openssl x509 -in "$f" -noout -fingerprint -sha256 2>/dev/null | sed 's/.*=//;s/://g'
+	fi
+done
+'''
+
+# Write the certificates given on stdin (one line with the name, one
+# line with the base64 encoded data each) to the directory given as $1,
+# then update the trust store by running $2
+INSTALL_SCRIPT = '''
+while read -r name && read -r data; do
+	printf '%s\\n' "$data" | base64 -d > "$1/$name" || exit 1
+done
+exec "$2"
+'''
+
+def certificateFingerprints(data):
+	result = [hashlib.sha256(data).hexdigest()]
+	try:
+		result.append(hashlib.sha256(pemToDER(data)).hexdigest())
+	except ValueError:
+		pass
+	return result
+
+class TrustManagerBase:
+	def addTrustedCertificate(self, name, data):
+		return self.addTrustedCertificates([(name, data)])
+
+	# Install a list of (name, data) certificates. Certificates that are
+	# already present in the trust-certificates directory (with any name)
+	# are skipped, and the trust store is updated once at the end.
+	def addTrustedCertificates(self, certs):
+		node = self.target
+
+		res = node.requireDirectory("trust-certificates")
+		if not res:
+			node.logFailure(f"Could not determine trust-certificates directory")
+			return False
+
+		installed = self.listInstalledFingerprints(res.path)
+		if installed is None:
+			return False
+
+		uploaded = []
+		for name, data in certs:
+			if isinstance(data, str):
+				data = data.encode('utf-8')
+
+			if any(fp in installed for fp in certificateFingerprints(data)):
+				node.logInfo(f"Certificate {name} is already trusted")
+				continue
+
+			path = os.path.join(res.path, name)
+			twopence.info(f"About to install trusted cert {name} as {path}")
+			st = node.sendbuffer(path, data, quiet = True, user = "root")
+			if not st:
+				node.logFailure(f"Failed to upload certificate to {path}: {st.message}")
+				return False
+
+			installed.update(certificateFingerprints(data))
+			uploaded.append(name)
+
+		if not uploaded:
+			return True
+
+		res = node.requireExecutable("update-certificate-trust")
+		if not res:
+			node.logFailure(f"Could not determine update-certificate-trust executable")
+			return False
+
+		st = res.run()
+		if not st:
+			node.logFailure(f"Failed to update certificates: {st.message}")
+			return False
+
+		node.logInfo(f"Installed certificate(s) {', '.join(uploaded)} as trusted")
+		return True
+
+	def listInstalledFingerprints(self, directory):
+		node = self.target
+
+		st = node.run(f"/bin/sh -s {shlex.quote(directory)}", stdin = LIST_SCRIPT.encode('utf-8'),
+				stdout = bytearray(), user = "root", quiet = True)
+		return self.parseInstalledFingerprints(st, directory)
+
+	def parseInstalledFingerprints(self, st, directory):
+		if not st:
+			self.target.logFailure(f"Unable to list certificates in {directory}: {st.message}")
+			return None
+
+		return set(line.strip().lower() for line in st.stdoutString.splitlines())
+
+	# The steps below are used by addTrustedCertificatesOnNodes. They do
+	# the same as addTrustedCertificates, but run the remote commands in
+	# the background, so that many nodes can be handled at the same time.
+	def startListInstalledFingerprints(self, directory):
+		return self.target.runBackground(f"/bin/sh -s {shlex.quote(directory)}",
+				stdin = LIST_SCRIPT.encode('utf-8'),
+				stdout = bytearray(), user = "root", quiet = True)
+
+	def startInstallCertificates(self, directory, certs, update):
+		stdin = bytearray()
+		for name, data in certs:
+			assert('/' not in name)
+			stdin += name.encode('utf-8') + b"\n" + base64.b64encode(data) + b"\n"
+
+		twopence.info(f"About to install trusted cert(s) {', '.join(name for name, data in certs)} in {directory}")
+		cmd = f"/bin/sh -c {shlex.quote(INSTALL_SCRIPT)} install {shlex.quote(directory)} {shlex.quote(update)}"
+		return self.target.runBackground(cmd, stdin = bytes(stdin), user = "root", quiet = True)
+
+##################################################################
+# Install certificates on many nodes at once.
+#
+# Each node must have a trust_manager application. Listing the installed
+# certificates, and uploading the missing ones along with the trust
+# store update, run as background commands on the nodes, with at most
+# maxWorkers nodes busy at the same time. All twopence calls and all
+# logging happen on the calling thread.
+#
+# Returns a dict mapping each node's name to a dict with the result
+# ("ok", True or False) and the time spent on that node in seconds.
+##################################################################
+def addTrustedCertificatesOnNodes(nodes, certs, maxWorkers = 8):
+	certs = [(name, isinstance(data, str) and data.encode('utf-8') or data) for name, data in certs]
+
+	started = {}
+	result = {}
+
+	def done(node, ok):
+		elapsed = time.monotonic() - started[node.name]
+		result[node.name] = {
+			"ok":	ok,
+			"time":	elapsed,
+		}
+		twopence.info(f"{node.name}: installing trusted certificates {ok and 'succeeded' or 'failed'} after {elapsed:.3f}s")
+
+	# Find out where to put the certificates, and how to update the trust store
+	paths = {}
+	for node in nodes:
+		started[node.name] = time.monotonic()
+
+		directory = node.requireDirectory("trust-certificates")
+		if not directory:
+			node.logFailure(f"Could not determine trust-certificates directory")
+			done(node, False)
+			continue
+
+		update = node.requireExecutable("update-certificate-trust")
+		if not update:
+			node.logFailure(f"Could not determine update-certificate-trust executable")
+			done(node, False)
+			continue
+
+		paths[node.name] = (directory.path, update.path)
+
+	# List the certificates each node already has
+	def startList(node):
+		directory, update = paths[node.name]
+		return node.managers.trust_manager.startListInstalledFingerprints(directory)
+
+	missing = {}
+	for node, st in runInBackground([node for node in nodes if node.name in paths], startList, maxWorkers):
+		directory, update = paths[node.name]
+		installed = node.managers.trust_manager.parseInstalledFingerprints(st, directory)
+		if installed is None:
+			done(node, False)
+			continue
+
+		upload = []
+		for name, data in certs:
+			if any(fp in installed for fp in certificateFingerprints(data)):
+				node.logInfo(f"Certificate {name} is already trusted")
+				continue
+			installed.update(certificateFingerprints(data))
+			upload.append((name, data))
+
+		if not upload:
+			done(node, True)
+			continue
+
+		missing[node.name] = upload
+
+	# Upload the missing certificates, and update the trust store
+	def startInstall(node):
+		directory, update = paths[node.name]
+		return node.managers.trust_manager.startInstallCertificates(directory, missing[node.name], update)
+
+	for node, st in runInBackground([node for node in nodes if node.name in missing], startInstall, maxWorkers):
+		if not st:
+			node.logFailure(f"Failed to install trusted certificates: {st.message}")
+			done(node, False)
+			continue
+
+		node.logInfo(f"Installed certificate(s) {', '.join(name for name, data in missing[node.name])} as trusted")
+		done(node, True)
+
+	return result
+
+# Call start(node) for each node, which starts a background command on
+# that node, keeping at most maxWorkers of them running at any time.
+# Yields (node, status) for every command, in the order they were started.
+def runInBackground(nodes, start, maxWorkers):
+	running = collections.deque()
+	for node in nodes:
+		if len(running) >= maxWorkers:
+			busy, cmd = running.popleft()
+			yield busy, busy.wait(cmd)
+		running.append((node, start(node)))
+
+	while running:
+		busy, cmd = running.popleft()
+		yield busy, busy.wait(cmd)
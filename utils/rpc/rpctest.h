@@ -91,6 +91,7 @@ extern int	rpctest_verify_status(int, CLIENT *, enum clnt_stat);
 extern int	rpctest_pidfile_check(const char *path);
 extern int	rpctest_pidfile_write(const char *path, pid_t pid);
 extern int	rpctest_pidfile_kill(const char *path);
+extern unsigned long rpctest_raise_nofile_limit(void);
 
 struct ifaddrs;
 extern const char *sockaddr_ntoa(const struct sockaddr *, const struct ifaddrs *);
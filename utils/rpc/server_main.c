@@ -28,6 +28,7 @@
 #include "rpctest.h"
 #include <getopt.h>
 #include <unistd.h>
+#include <signal.h>
 
 int
 main(int argc, char **argv)
@@ -98,6 +99,8 @@ main(int argc, char **argv)
 		}
 	}
 
+	/* Allow for one socket per stress client job */
+	rpctest_raise_nofile_limit();
 
 	if (num_nettypes) {
 		unsigned int i = 0;
@@ -125,6 +128,10 @@ main(int argc, char **argv)
 			return 22;
 	}
 
+	/* Stress clients may go away while calls are still in flight.
+	 * Don't let the resulting EPIPE kill us. */
+	signal(SIGPIPE, SIG_IGN);
+
 	svc_run();
 	exit(1);
 }
@@ -26,12 +26,37 @@
  *  ./rpc.sqaured
  *  ./square stress runtime=60 jobs=120 trace=1
  *
- * FIXME:
- *  Introduce UDP jobs
+ * With summary=<path>, a machine readable summary of the run (call
+ * rate, errors and latency percentiles) is written to <path> in JSON
+ * format. Use summary=- to write it to stdout.
+ *
+ * Latencies are recorded in log-scale histograms covering 0..hist-max
+ * msec (by default, the job timeout), with hist-precision significant
+ * digits (default 2). With interval=<sec>, the client prints the reply
+ * latency percentiles of each interval (covering all kinds of jobs),
+ * and includes them in the summary.
+ *
+ * By default, each job has one call outstanding at any time. With
+ * window=<n>, jobs keep up to n calls in flight on their connection.
+ * In addition to the TCP jobs, udp-jobs=<n> starts n jobs that send
+ * their calls via UDP. Calls that are not answered within udp-timeout
+ * msec are retransmitted (with exponential backoff) up to udp-retries
+ * times before we count them as failed.
+ *
+ * The default engine drives all jobs from a single poll() loop. With
+ * engine=epoll threads=<n>, the jobs are split across n worker threads
+ * instead, each with its own epoll instance, jobs and histograms. The
+ * results of all threads are merged at the end of the run.
+ *
+ * Every job uses a socket of its own. The client raises its limit on
+ * open files to the hard limit, and reduces the number of jobs if they
+ * still would not fit.
  */
 
 #include <sys/poll.h>
+#include <sys/epoll.h>
 #include <sys/resource.h>
+#include <pthread.h>
 #include <time.h>
 #include <unistd.h>
 #include <errno.h>
@@ -40,7 +65,19 @@
 #include "square.h"
 
 #define BASE_PORT		0
-#define HIST_MAX		100
+
+/* How often the epoll engine checks for job timeouts and UDP retransmits (msec) */
+#define EPOLL_HOUSEKEEPING	50
+#define EPOLL_MAX_EVENTS	256
+
+/* File descriptors we need in addition to one socket per job: stdio,
+ * the summary file, rpcbind lookups, plus one epoll fd per thread */
+#define STRESS_RESERVED_FDS	16
+
+enum {
+	STRESS_ENGINE_POLL,
+	STRESS_ENGINE_EPOLL,
+};
 
 struct stress_opts {
 	int			trace;
@@ -52,28 +89,120 @@ struct stress_opts {
 
 	unsigned int		njobs;
 	unsigned int		max_errors;
-	time_t			end_time;
+	struct timeval		end_time;
+
+	/* Number of calls each job keeps in flight */
+	unsigned int		window;
+
+	int			engine;
+	unsigned int		threads;
+
+	/* UDP jobs, and their retransmit timeout (msec) and retries */
+	unsigned int		udp_jobs;
+	unsigned int		udp_timeout;
+	unsigned int		udp_retries;
+
+	const char *		summary_path;
+
+	/* Report interval in seconds, 0 means no interval reports */
+	unsigned int		interval;
+
+	/* Histogram range in msec, and number of significant digits */
+	unsigned int		hist_max;
+	unsigned int		hist_precision;
+};
+
+struct histogram {
+	unsigned int		sub_bits;
+	unsigned int		nbuckets;
+	unsigned long		max_usec;
+	unsigned long *		values;
+
+	unsigned long		count;
+	unsigned long		overflow;
+	unsigned long		min, max;
+	double			sum;
+};
+
+/* Calls and errors during one report interval, and the reply latencies
+ * of all TCP, pipelined and UDP calls made in it */
+struct stress_snapshot {
+	double			time;
+	unsigned long		calls;
+	unsigned int		errors;
+	struct histogram	reply;
 };
 
 struct sumclnt {
+	/* Prefix for job names; used to tell apart the jobs of worker threads */
+	char			name[16];
+
 	struct sockaddr_storage	svc_addr;
 	socklen_t		svc_addrlen;
+	struct sockaddr_storage	udp_addr;
+	socklen_t		udp_addrlen;
 
 	struct stress_opts	conf;
 
-	/* Number of calls made */
+	/* Total number of jobs, TCP and UDP */
+	unsigned int		njobs;
+
+	struct timeval		start_time;
+
+	/* Number of calls made, and errors. The main thread reads the
+	 * counters of the worker threads while they are running. */
 	unsigned long		ncalls;
+	unsigned int		errors;
 
 	struct sumjob **	jobs;
 
-	unsigned int		errors;
+	/* Each worker thread has its own PRNG, see stress_random() */
+	uint64_t		random_state;
+
+	unsigned long		udp_retransmits;
+	unsigned long		udp_timeouts;
+	unsigned long		udp_stale;
+
+	struct histogram	send_histogram;
+	struct histogram	recv_histogram;
+	struct histogram	pipeline_histogram;
+	struct histogram	udp_histogram;
+
+	/* Reply latencies since the last interval report, and the
+	 * number of calls and errors as of that report */
+	struct histogram	interval_histogram;
+	struct timeval		next_report;
+	unsigned long		reported_calls;
+	unsigned int		reported_errors;
+
+	struct stress_snapshot *snapshots;
+	unsigned int		nsnapshots;
+
+	/* epoll engine */
+	int			epfd;
+	struct timeval		next_housekeeping;
+	pthread_t		thread;
+	int			stop;
+
+	/* Worker threads, and their results */
+	struct sumclnt **	workers;
+	unsigned int		nworkers;
+};
 
-	struct histogram {
-		double		xrange;
-		double		xscale;
+/*
+ * A call that has been sent, and is waiting for a reply
+ */
+struct sumcall {
+	int			active;
+	uint32_t		xid;
+	unsigned int		sum;
+	struct timeval		begin;
 
-		unsigned int	values[HIST_MAX];
-	} send_histogram, recv_histogram;
+	/* UDP only: the packet, for retransmission */
+	unsigned char *		buf;
+	unsigned int		len;
+	unsigned int		retransmits;
+	struct timeval		deadline;
 };
 
 struct sumjob {
@@ -87,10 +216,20 @@ struct sumjob {
 	struct timeval		ctime;
 	struct timeval		timeout;
 	uint32_t		xid;
+	uint64_t *		random_state;
 
 	unsigned int		ncalls;
 	unsigned int		max_calls;
 
+	/* Calls in flight */
+	unsigned int		window;
+	unsigned int		nsent;
+	unsigned int		ninflight;
+	struct sumcall *	calls;
+
+	/* Histogram of reply times for this kind of job */
+	struct histogram *	recv_histogram;
+
 	unsigned int		num_ints;
 
 	struct {
@@ -102,8 +241,6 @@ struct sumjob {
 		unsigned int	pos;
 	} send;
 	struct {
-		struct timeval	begin;
-
 		unsigned char *	buf;
 		unsigned int	size;
 		unsigned int	len;
@@ -112,6 +249,10 @@ struct sumjob {
 
 	unsigned int		sum;
 
+	/* The events we asked epoll to watch for */
+	char			epoll_added;
+	int			epoll_events;
+
 	/* If we got EMFILE when trying to create the socket, then
 	 * we do not want to try this again.
 	 * Mark this job as dead, but prevent it from being destroyed
@@ -133,16 +274,31 @@ static unsigned int	xid = 0x1234abcd;
 static struct sumclnt *	sumclnt_new(const char *hostname, struct stress_opts *opt);
 static void		sumclnt_free(struct sumclnt *clnt);
 static int		sumclnt_poll(struct sumclnt *clnt);
+static int		sumclnt_epoll(struct sumclnt *clnt);
+static struct sumjob *	sumclnt_start_job(struct sumclnt *clnt, unsigned int i);
+static int		sumclnt_handle_events(struct sumclnt *clnt, struct sumjob *job, int revents);
+static void		sumclnt_check_timeout(struct sumclnt *clnt, struct sumjob *job, struct timeout *timeout);
+static int		sumclnt_run_threads(struct sumclnt *clnt);
+static void		sumclnt_merge(struct sumclnt *clnt, const struct sumclnt *worker);
+static void		sumclnt_report_interval(struct sumclnt *clnt);
+static int		stress_runtime_expired(const struct stress_opts *opt);
+static void		stress_snapshot_print(const struct stress_snapshot *snap);
 
 static struct sumjob *	sumjob_new(struct sumclnt *clnt, unsigned int jobid, unsigned int num_ints);
 static int		sumjob_connect(struct sumclnt *clnt, struct sumjob *job);
 static int		sumjob_build_packet(struct sumjob *job);
+static unsigned long	stress_random(uint64_t *state);
 static void		sumjob_drop_buffers(struct sumjob *job);
+static void		__sumjob_set_timeout(struct timeval *deadline, unsigned long timeout_usec);
 static void		sumjob_set_timeout(struct sumclnt *clnt, struct sumjob *job);
 static void		sumjob_close(struct sumjob *job);
 static int		sumjob_send(struct sumclnt *clnt, struct sumjob *job);
 static int		sumjob_recv(struct sumclnt *clnt, struct sumjob *job);
-static int		sumjob_check_reply(struct sumjob *job);
+static int		sumjob_check_reply(struct sumjob *job, struct sumcall **callp);
+static int		sumjob_next_call(struct sumjob *job);
+static void		sumjob_call_sent(struct sumclnt *clnt, struct sumjob *job);
+static void		sumjob_call_done(struct sumclnt *clnt, struct sumjob *job, struct sumcall *call);
+static void		sumjob_retransmit(struct sumclnt *clnt, struct sumjob *job);
 static void		sumjob_timeout(struct sumjob *);
 static void		sumjob_print(const struct sumjob *);
 static void		sumjob_free(struct sumjob *);
@@ -151,9 +307,18 @@ static void		timeout_init(struct timeout *, long initial_timeout);
 static int		timeout_update(struct timeout *tmo, const struct timeval *expire);
 static long		timeout_value(const struct timeout *tmo);
 
-static void		hist_init(struct histogram *h, double xrange);
+static void		hist_init(struct histogram *h, unsigned long max_usec, unsigned int precision);
+static void		hist_destroy(struct histogram *h);
+static unsigned long	hist_delay(const struct timeval *t0);
+static void		hist_add(struct histogram *h, unsigned long usec);
+static void		hist_merge(struct histogram *h, const struct histogram *other);
 static void		hist_record(struct histogram *h, const struct timeval *t0);
-static void		hist_print(struct histogram *h, unsigned int nlines);
+static void		hist_print(struct histogram *h);
+static unsigned long	hist_percentile(const struct histogram *h, double pct);
+static void		hist_print_json(FILE *fp, const struct histogram *h);
+
+static FILE *		stress_open_summary(const char *path);
+static int		stress_write_summary(struct sumclnt *clnt, const char *path, FILE *fp);
 
 static void
 stress_opts_init_defaults(struct stress_opts *opt)
@@ -162,6 +327,10 @@ stress_opts_init_defaults(struct stress_opts *opt)
 	opt->max_calls = 32;
 	opt->njobs = 128;
 	opt->max_errors = 256;
+	opt->window = 1;
+	opt->udp_timeout = 1000;
+	opt->udp_retries = 4;
+	opt->hist_precision = 2;
 }
 
 static int
@@ -182,11 +351,41 @@ stress_opts_set(struct stress_opts *opt, int argc, char **argv)
 			continue;
 		}
 
+		if (!strcmp(name, "engine")) {
+			if (value && !strcmp(value, "poll")) {
+				opt->engine = STRESS_ENGINE_POLL;
+			} else
+			if (value && !strcmp(value, "epoll")) {
+				opt->engine = STRESS_ENGINE_EPOLL;
+			} else {
+				log_error("%s must be either poll or epoll", name);
+				goto ignore_arg;
+			}
+			continue;
+		}
+
+		if (!strcmp(name, "summary")) {
+			if (!value) {
+				log_error("missing value to %s argument", name);
+				goto ignore_arg;
+			}
+			opt->summary_path = value;
+			continue;
+		}
+
 		if (!strcmp(name, "runtime")
 		 || !strcmp(name, "jobs")
 		 || !strcmp(name, "job-timeout")
 		 || !strcmp(name, "max-calls")
-		 || !strcmp(name, "max-errors")) {
+		 || !strcmp(name, "max-errors")
+		 || !strcmp(name, "window")
+		 || !strcmp(name, "threads")
+		 || !strcmp(name, "udp-jobs")
+		 || !strcmp(name, "udp-timeout")
+		 || !strcmp(name, "udp-retries")
+		 || !strcmp(name, "interval")
+		 || !strcmp(name, "hist-max")
+		 || !strcmp(name, "hist-precision")) {
 			char *s;
 
 			if (!value) {
@@ -201,7 +400,7 @@ stress_opts_set(struct stress_opts *opt, int argc, char **argv)
 					goto ignore_arg;
 				}
 				number = rlim.rlim_cur;
-				printf("Using %s=%lu - expect a few error messages\n", name, number);
+				printf("Using %s=%lu\n", name, number);
 			} else {
 				number = strtoul(value, &s, 0);
 				if (s && *s) {
@@ -217,7 +416,7 @@ stress_opts_set(struct stress_opts *opt, int argc, char **argv)
 		}
 
 		if (!strcmp(name, "runtime")) {
-			opt->end_time = time(NULL) + number;
+			__sumjob_set_timeout(&opt->end_time, number * 1000000UL);
 			continue;
 		}
 		if (!strcmp(name, "jobs")) {
@@ -236,6 +435,42 @@ stress_opts_set(struct stress_opts *opt, int argc, char **argv)
 			opt->max_errors = number;
 			continue;
 		}
+		if (!strcmp(name, "window")) {
+			opt->window = number;
+			continue;
+		}
+		if (!strcmp(name, "threads")) {
+			opt->threads = number;
+			continue;
+		}
+		if (!strcmp(name, "udp-jobs")) {
+			opt->udp_jobs = number;
+			continue;
+		}
+		if (!strcmp(name, "udp-timeout")) {
+			opt->udp_timeout = number;
+			continue;
+		}
+		if (!strcmp(name, "udp-retries")) {
+			opt->udp_retries = number;
+			continue;
+		}
+		if (!strcmp(name, "interval")) {
+			opt->interval = number;
+			continue;
+		}
+		if (!strcmp(name, "hist-max")) {
+			opt->hist_max = number;
+			continue;
+		}
+		if (!strcmp(name, "hist-precision")) {
+			if (number > 4) {
+				log_error("%s value must be between 1 and 4", name);
+				goto ignore_arg;
+			}
+			opt->hist_precision = number;
+			continue;
+		}
 
 		log_error("unknown argument \"%s\"", name);
 ignore_arg:
@@ -249,6 +484,16 @@ ignore_arg:
 	if (opt->job_timeout < 10)
 		opt->job_timeout = 10;
 
+	/* Multiple threads imply the epoll engine */
+	if (opt->threads > 1)
+		opt->engine = STRESS_ENGINE_EPOLL;
+	if (opt->threads == 0)
+		opt->threads = 1;
+
+	/* By default, the histograms cover everything up to the job timeout */
+	if (opt->hist_max == 0)
+		opt->hist_max = opt->job_timeout * 1000;
+
 	return 0;
 }
 
@@ -257,21 +502,44 @@ do_stress(const char *hostname, const char *netid, int argc, char **argv)
 {
 	struct stress_opts opt;
 	struct sumclnt *clnt;
+	unsigned long nfiles, avail;
+	FILE *summary = NULL;
 	int exitval = 0;
 
 	srandom(getpid());
+	nfiles = rpctest_raise_nofile_limit();
+
 	stress_opts_init_defaults(&opt);
 	stress_opts_set(&opt, argc, argv);
 
+	/* Each job needs a socket; don't start more jobs than we can open */
+	if (nfiles <= STRESS_RESERVED_FDS + opt.threads)
+		log_fatal("RLIMIT_NOFILE of %lu is too small", nfiles);
+	avail = nfiles - STRESS_RESERVED_FDS - opt.threads;
+	if (opt.udp_jobs > avail)
+		opt.udp_jobs = avail;
+	if (opt.njobs + opt.udp_jobs > avail) {
+		printf("Only %lu files available, reducing jobs=%u to %lu\n",
+				nfiles, opt.njobs, avail - opt.udp_jobs);
+		opt.njobs = avail - opt.udp_jobs;
+	}
+
+	/* Open the summary file now, while we still have file descriptors */
+	if (opt.summary_path && !(summary = stress_open_summary(opt.summary_path)))
+		return 1;
+
 	clnt = sumclnt_new(hostname, &opt);
 
 	/* FIXME: warn if the runtime is smaller than the default job timeout */
 
-	while (1) {
+	if (opt.engine == STRESS_ENGINE_EPOLL) {
+		if (sumclnt_run_threads(clnt) < 0)
+			return 1;
+	} else while (1) {
 		if (sumclnt_poll(clnt) < 0)
 			return 1;
 
-		if (opt.end_time && opt.end_time <= time(NULL))
+		if (stress_runtime_expired(&opt))
 			break;
 		if (clnt->errors >= opt.max_errors) {
 			log_error("Too many errors, aborting this run");
@@ -288,42 +556,112 @@ do_stress(const char *hostname, const char *netid, int argc, char **argv)
 	}
 
 	printf("\n\nSend histogram (time needed to send a full packet)\n");
-	hist_print(&clnt->send_histogram, 16);
+	hist_print(&clnt->send_histogram);
+
+	if (clnt->recv_histogram.count) {
+		printf("\n\nReceive histogram (time taken to receive a full reply)\n");
+		hist_print(&clnt->recv_histogram);
+	}
+
+	if (clnt->pipeline_histogram.count) {
+		printf("\n\nPipelined receive histogram (time from sending a call to receiving its reply)\n");
+		hist_print(&clnt->pipeline_histogram);
+	}
+
+	if (clnt->conf.udp_jobs) {
+		printf("\n\nUDP receive histogram (time from first transmission to receiving the reply)\n");
+		hist_print(&clnt->udp_histogram);
+		printf("%lu retransmits, %lu calls timed out, %lu stale replies\n",
+				clnt->udp_retransmits, clnt->udp_timeouts, clnt->udp_stale);
+	}
+
+	if (summary && stress_write_summary(clnt, opt.summary_path, summary) < 0)
+		exitval = 1;
 
-	printf("\n\nReceive histogram (time taken to receive a full reply)\n");
-	hist_print(&clnt->recv_histogram, 16);
- 
 	sumclnt_free(clnt);
 	return exitval;
 }
 
-struct sumclnt *
-sumclnt_new(const char *hostname, struct stress_opts *opt)
+static void
+sumclnt_getaddr(const char *hostname, const char *netid, struct sockaddr_storage *addr, socklen_t *alen)
 {
 	struct netconfig *nconf;
-	struct sumclnt *clnt;
 	struct netbuf abuf;
 
-	clnt = calloc(1, sizeof(*clnt));
-	clnt->conf = *opt;
-
-	abuf.buf = &clnt->svc_addr;
-	abuf.len = abuf.maxlen = sizeof(clnt->svc_addr);
+	abuf.buf = addr;
+	abuf.len = abuf.maxlen = sizeof(*addr);
 
-	nconf = getnetconfigent("tcp");
+	nconf = getnetconfigent(netid);
 
 	if (!rpcb_getaddr(SQUARE_PROG, SQUARE_VERS, nconf, &abuf, hostname))
 		log_fatal("Cannot find square service on host %s", hostname);
 	freenetconfigent(nconf);
-	clnt->svc_addrlen = abuf.len;
+	*alen = abuf.len;
+}
+
+static struct sumclnt *
+sumclnt_alloc(const struct stress_opts *opt)
+{
+	struct sumclnt *clnt;
+	unsigned long max_usec = opt->hist_max * 1000UL;
+
+	clnt = calloc(1, sizeof(*clnt));
+	clnt->conf = *opt;
+	clnt->epfd = -1;
+	clnt->random_state = ((uint64_t) random() << 32) | random() | 1;
+	gettimeofday(&clnt->start_time, NULL);
+
+	clnt->njobs = opt->njobs + opt->udp_jobs;
+	clnt->jobs = calloc(clnt->njobs, sizeof(clnt->jobs[0]));
+
+	hist_init(&clnt->send_histogram, max_usec, opt->hist_precision);
+	hist_init(&clnt->recv_histogram, max_usec, opt->hist_precision);
+	hist_init(&clnt->pipeline_histogram, max_usec, opt->hist_precision);
+	hist_init(&clnt->udp_histogram, max_usec, opt->hist_precision);
+	hist_init(&clnt->interval_histogram, max_usec, opt->hist_precision);
+	__sumjob_set_timeout(&clnt->next_report, opt->interval * 1000000UL);
+
+	return clnt;
+}
+
+struct sumclnt *
+sumclnt_new(const char *hostname, struct stress_opts *opt)
+{
+	struct sumclnt *clnt;
+
+	clnt = sumclnt_alloc(opt);
+
+	sumclnt_getaddr(hostname, "tcp", &clnt->svc_addr, &clnt->svc_addrlen);
+	if (opt->udp_jobs)
+		sumclnt_getaddr(hostname, "udp", &clnt->udp_addr, &clnt->udp_addrlen);
+
+	return clnt;
+}
 
-	clnt->jobs = calloc(opt->njobs, sizeof(clnt->jobs[0]));
+/*
+ * Create a client for a worker thread, which runs njobs TCP and
+ * udp_jobs UDP jobs.
+ */
+static struct sumclnt *
+sumclnt_new_worker(const struct sumclnt *parent, unsigned int index, unsigned int njobs, unsigned int udp_jobs)
+{
+	struct stress_opts opt = parent->conf;
+	struct sumclnt *clnt;
 
-	/* Send histogram is 0..500 msec */
-	hist_init(&clnt->send_histogram, 500 * 1e-3);
+	opt.njobs = njobs;
+	opt.udp_jobs = udp_jobs;
 
-	/* Recv histogram is 0..500 msec */
-	hist_init(&clnt->recv_histogram, 10000 * 1e-3);
+	clnt = sumclnt_alloc(&opt);
+	snprintf(clnt->name, sizeof(clnt->name), "t%u.", index);
+
+	clnt->svc_addr = parent->svc_addr;
+	clnt->svc_addrlen = parent->svc_addrlen;
+	clnt->udp_addr = parent->udp_addr;
+	clnt->udp_addrlen = parent->udp_addrlen;
+
+	clnt->epfd = epoll_create1(EPOLL_CLOEXEC);
+	if (clnt->epfd < 0)
+		log_fatal("epoll_create: %m");
 
 	return clnt;
 }
@@ -333,7 +671,7 @@ sumclnt_free(struct sumclnt *clnt)
 {
 	unsigned int i;
 
-	for (i = 0; i < clnt->conf.njobs; ++i) {
+	for (i = 0; i < clnt->njobs; ++i) {
 		struct sumjob *job = clnt->jobs[i];
 
 		if (job)
@@ -342,6 +680,24 @@ sumclnt_free(struct sumclnt *clnt)
 	}
 
 	free(clnt->jobs);
+
+	hist_destroy(&clnt->send_histogram);
+	hist_destroy(&clnt->recv_histogram);
+	hist_destroy(&clnt->pipeline_histogram);
+	hist_destroy(&clnt->udp_histogram);
+	hist_destroy(&clnt->interval_histogram);
+
+	for (i = 0; i < clnt->nsnapshots; ++i)
+		hist_destroy(&clnt->snapshots[i].reply);
+	free(clnt->snapshots);
+
+	for (i = 0; i < clnt->nworkers; ++i)
+		sumclnt_free(clnt->workers[i]);
+	free(clnt->workers);
+
+	if (clnt->epfd >= 0)
+		close(clnt->epfd);
+
 	free(clnt);
 }
 
@@ -354,21 +710,13 @@ sumclnt_poll(struct sumclnt *clnt)
 
 	timeout_init(&timeout, 10000);
 
-	pfd = alloca(clnt->conf.njobs * sizeof(pfd[0]));
-	for (i = nfds = 0; i < clnt->conf.njobs; ++i) {
+	pfd = alloca(clnt->njobs * sizeof(pfd[0]));
+	for (i = nfds = 0; i < clnt->njobs; ++i) {
 		struct sumjob *job = clnt->jobs[i];
 		struct pollfd *p;
 
-		if (job == NULL) {
-			job = sumjob_new(clnt, i, random() % 65536);
-			if (job == NULL)
-				log_fatal("Unable to create new sum job");
-			if (sumjob_connect(clnt, job) < 0) {
-				log_error("Unable to connect to server");
-			}
-			sumjob_set_timeout(clnt, job);
-			clnt->jobs[i] = job;
-		}
+		if (job == NULL)
+			job = sumclnt_start_job(clnt, i);
 
 		if (job->fd < 0) {
 			job->pollfd = NULL;
@@ -379,23 +727,34 @@ sumclnt_poll(struct sumclnt *clnt)
 
 		p->fd = job->fd;
 		p->events = 0;
-		if (job->send.pos >= job->send.len) {
-			/* We already sent everything. */
-			p->events = POLLIN;
-		} else {
+		if (job->send.pos < job->send.len) {
 			p->events = POLLOUT | POLLHUP;
 			job->last_activity = '.';
 		}
+		if (job->ninflight)
+			p->events |= POLLIN;
 
 		p->events |= POLLERR;
 		p->revents = 0;
+
+		/* Wake up in time for the next UDP retransmit */
+		if (job->proto == IPPROTO_UDP) {
+			unsigned int k;
+
+			for (k = 0; k < job->window; ++k) {
+				struct sumcall *call = &job->calls[k];
+
+				if (call->active && timeout_update(&timeout, &call->deadline) < 0)
+					timeout.current = 0;
+			}
+		}
 	}
 
 	if (poll(pfd, nfds, timeout_value(&timeout)) < 0)
 		log_fatal("poll: %m");
 
 	timeout_init(&timeout, -1);
-	for (i = 0; i < clnt->conf.njobs; ++i) {
+	for (i = 0; i < clnt->njobs; ++i) {
 		struct sumjob *job = clnt->jobs[i];
 		struct pollfd *p;
 
@@ -404,41 +763,14 @@ sumclnt_poll(struct sumclnt *clnt)
 			continue;
 		}
 
-		if (p->revents & POLLERR) {
-			log_error("%s: detected POLLERR - remote closed connection?", job->name);
-			job->last_activity = '*';
-			sumjob_close(job);
-			clnt->errors++;
-			continue;
-		}
-
-		if (p->revents & POLLOUT) {
-			if (sumjob_send(clnt, job) < 0)
-				log_fatal("Unable to send data");
-		} else
-		if (p->revents & POLLIN) {
-			if (sumjob_recv(clnt, job) < 0)
-				log_fatal("Unable to recv data");
-		} else
-		if (p->revents & POLLHUP) {
-			log_error("%s: remote closed connection", job->name);
-			job->last_activity = '*';
-			sumjob_close(job);
-			clnt->errors++;
+		if (sumclnt_handle_events(clnt, job, p->revents) < 0)
 			continue;
-		}
 
-		/* Check for job timeout */
-		if (timeout_update(&timeout, &job->timeout) < 0) {
-			sumjob_timeout(job);
-			job->last_activity = 't';
-			clnt->errors++;
-			continue;
-		}
+		sumclnt_check_timeout(clnt, job, &timeout);
 	}
 
 	if (clnt->conf.trace) {
-		for (i = 0; i < clnt->conf.njobs; ++i) {
+		for (i = 0; i < clnt->njobs; ++i) {
 			struct sumjob *job = clnt->jobs[i];
 
 			if (!job) {
@@ -450,18 +782,22 @@ sumclnt_poll(struct sumclnt *clnt)
 		}
 		printf(":\n");
 		fflush(stdout);
-	} else {
-		static time_t next_report;
-		time_t now = time(NULL);
+	} else
+	if (clnt->conf.interval == 0) {
+		struct timeval now;
 
-		if (now >= next_report) {
+		gettimeofday(&now, NULL);
+		if (timercmp(&now, &clnt->next_report, >=)) {
 			printf("%lu... ", clnt->ncalls);
 			fflush(stdout);
-			next_report = now + 1;
+			__sumjob_set_timeout(&clnt->next_report, 1000000);
 		}
 	}
 
-	for (i = 0; i < clnt->conf.njobs; ++i) {
+	if (clnt->conf.interval)
+		sumclnt_report_interval(clnt);
+
+	for (i = 0; i < clnt->njobs; ++i) {
 		struct sumjob *job = clnt->jobs[i];
 
 		if (!job)
@@ -477,6 +813,410 @@ sumclnt_poll(struct sumclnt *clnt)
 	return 0;
 }
 
+/*
+ * Create and connect job number i
+ */
+static struct sumjob *
+sumclnt_start_job(struct sumclnt *clnt, unsigned int i)
+{
+	struct sumjob *job;
+
+	/* UDP calls must fit into the RPC library's datagram buffers */
+	if (i >= clnt->conf.njobs)
+		job = sumjob_new(clnt, i, stress_random(&clnt->random_state) % 2048);
+	else
+		job = sumjob_new(clnt, i, stress_random(&clnt->random_state) % 65536);
+	if (job == NULL)
+		log_fatal("Unable to create new sum job");
+	if (sumjob_connect(clnt, job) < 0) {
+		log_error("Unable to connect to server");
+	}
+	sumjob_set_timeout(clnt, job);
+	clnt->jobs[i] = job;
+	return job;
+}
+
+/*
+ * Handle the poll events reported for a job. Returns -1 if the job
+ * was closed because of an error.
+ */
+static int
+sumclnt_handle_events(struct sumclnt *clnt, struct sumjob *job, int revents)
+{
+	if (revents & POLLERR) {
+		log_error("%s: detected POLLERR - remote closed connection?", job->name);
+		job->last_activity = '*';
+		sumjob_close(job);
+		__atomic_add_fetch(&clnt->errors, 1, __ATOMIC_RELAXED);
+		return -1;
+	}
+
+	if ((revents & POLLHUP) && !(revents & (POLLIN | POLLOUT))) {
+		log_error("%s: remote closed connection", job->name);
+		job->last_activity = '*';
+		sumjob_close(job);
+		__atomic_add_fetch(&clnt->errors, 1, __ATOMIC_RELAXED);
+		return -1;
+	}
+
+	if (revents & POLLOUT) {
+		if (sumjob_send(clnt, job) < 0)
+			log_fatal("Unable to send data");
+	}
+	if ((revents & POLLIN) && job->fd >= 0) {
+		if (sumjob_recv(clnt, job) < 0)
+			log_fatal("Unable to recv data");
+	}
+
+	if (job->proto == IPPROTO_UDP && job->fd >= 0)
+		sumjob_retransmit(clnt, job);
+
+	return 0;
+}
+
+static void
+sumclnt_check_timeout(struct sumclnt *clnt, struct sumjob *job, struct timeout *timeout)
+{
+	if (job->fd >= 0 && timeout_update(timeout, &job->timeout) < 0) {
+		sumjob_timeout(job);
+		job->last_activity = 't';
+		__atomic_add_fetch(&clnt->errors, 1, __ATOMIC_RELAXED);
+	}
+}
+
+/*
+ * The epoll engine.
+ *
+ * Unlike sumclnt_poll, this does not look at every job in each
+ * iteration. We only touch the jobs that epoll reports events for;
+ * job timeouts and UDP retransmits are checked every
+ * EPOLL_HOUSEKEEPING msec.
+ */
+static void
+sumjob_update_epoll(struct sumclnt *clnt, struct sumjob *job)
+{
+	struct epoll_event ev;
+	int events = 0;
+
+	if (job->fd < 0) {
+		/* Closing the socket removed it from the epoll set */
+		job->epoll_added = 0;
+		return;
+	}
+
+	if (job->send.pos < job->send.len)
+		events |= EPOLLOUT;
+	if (job->ninflight)
+		events |= EPOLLIN;
+
+	if (job->epoll_added && events == job->epoll_events)
+		return;
+
+	memset(&ev, 0, sizeof(ev));
+	ev.events = events;
+	ev.data.ptr = job;
+
+	if (epoll_ctl(clnt->epfd, job->epoll_added? EPOLL_CTL_MOD : EPOLL_CTL_ADD, job->fd, &ev) < 0)
+		log_fatal("epoll_ctl: %m");
+
+	job->epoll_added = 1;
+	job->epoll_events = events;
+}
+
+/*
+ * Replace a job that has finished (or failed) with a new one
+ */
+static struct sumjob *
+sumclnt_restart_job(struct sumclnt *clnt, struct sumjob *job)
+{
+	unsigned int i = job->id;
+
+	if (job->fd >= 0 || job->mummified)
+		return job;
+
+	sumjob_free(job);
+	clnt->jobs[i] = NULL;
+
+	job = sumclnt_start_job(clnt, i);
+	sumjob_update_epoll(clnt, job);
+	return job;
+}
+
+static void
+sumclnt_housekeeping(struct sumclnt *clnt)
+{
+	struct timeout timeout;
+	unsigned int i;
+
+	timeout_init(&timeout, -1);
+	for (i = 0; i < clnt->njobs; ++i) {
+		struct sumjob *job = clnt->jobs[i];
+
+		if (job == NULL) {
+			job = sumclnt_start_job(clnt, i);
+		} else {
+			if (job->proto == IPPROTO_UDP && job->fd >= 0)
+				sumjob_retransmit(clnt, job);
+			sumclnt_check_timeout(clnt, job, &timeout);
+			job = sumclnt_restart_job(clnt, job);
+		}
+		sumjob_update_epoll(clnt, job);
+	}
+
+	if (clnt->conf.interval)
+		sumclnt_report_interval(clnt);
+
+	__sumjob_set_timeout(&clnt->next_housekeeping, EPOLL_HOUSEKEEPING * 1000);
+}
+
+int
+sumclnt_epoll(struct sumclnt *clnt)
+{
+	struct epoll_event events[EPOLL_MAX_EVENTS];
+	struct timeout timeout;
+	int i, n;
+
+	timeout_init(&timeout, EPOLL_HOUSEKEEPING);
+	if (timeout_update(&timeout, &clnt->next_housekeeping) < 0) {
+		sumclnt_housekeeping(clnt);
+		timeout_init(&timeout, EPOLL_HOUSEKEEPING);
+	}
+
+	n = epoll_wait(clnt->epfd, events, EPOLL_MAX_EVENTS, timeout_value(&timeout));
+	if (n < 0) {
+		if (errno == EINTR)
+			return 0;
+		log_fatal("epoll_wait: %m");
+	}
+
+	for (i = 0; i < n; ++i) {
+		struct sumjob *job = events[i].data.ptr;
+		int revents = 0;
+
+		if (events[i].events & EPOLLIN)
+			revents |= POLLIN;
+		if (events[i].events & EPOLLOUT)
+			revents |= POLLOUT;
+		if (events[i].events & EPOLLERR)
+			revents |= POLLERR;
+		if (events[i].events & EPOLLHUP)
+			revents |= POLLHUP;
+
+		sumclnt_handle_events(clnt, job, revents);
+
+		job = sumclnt_restart_job(clnt, job);
+		sumjob_update_epoll(clnt, job);
+	}
+
+	return 0;
+}
+
+static void *
+sumclnt_thread(void *arg)
+{
+	struct sumclnt *clnt = arg;
+
+	gettimeofday(&clnt->start_time, NULL);
+	__sumjob_set_timeout(&clnt->next_report, clnt->conf.interval * 1000000UL);
+	while (!__atomic_load_n(&clnt->stop, __ATOMIC_RELAXED)) {
+		if (sumclnt_epoll(clnt) < 0)
+			break;
+		if (stress_runtime_expired(&clnt->conf))
+			break;
+	}
+
+	return NULL;
+}
+
+/*
+ * Split the jobs across worker threads, and run them until the
+ * runtime is up or there are too many errors. Then merge the
+ * results of all workers into clnt.
+ */
+int
+sumclnt_run_threads(struct sumclnt *clnt)
+{
+	unsigned int nthreads = clnt->conf.threads;
+	unsigned int i, errors = 0;
+	unsigned long ncalls;
+
+	if (clnt->conf.trace)
+		fprintf(stderr, "trace is not supported by the epoll engine\n");
+
+	clnt->workers = calloc(nthreads, sizeof(clnt->workers[0]));
+	for (i = 0; i < nthreads; ++i) {
+		unsigned int njobs, udp_jobs;
+		struct sumclnt *worker;
+
+		njobs = clnt->conf.njobs / nthreads + (i < clnt->conf.njobs % nthreads);
+		udp_jobs = clnt->conf.udp_jobs / nthreads + (i < clnt->conf.udp_jobs % nthreads);
+		if (njobs + udp_jobs == 0)
+			break;
+
+		worker = sumclnt_new_worker(clnt, i, njobs, udp_jobs);
+		clnt->workers[clnt->nworkers++] = worker;
+	}
+
+	for (i = 0; i < clnt->nworkers; ++i) {
+		if (pthread_create(&clnt->workers[i]->thread, NULL, sumclnt_thread, clnt->workers[i]) != 0)
+			log_fatal("Unable to create worker thread");
+	}
+
+	/* Report progress, and stop everyone if there are too many errors */
+	while (!stress_runtime_expired(&clnt->conf)) {
+		sleep(1);
+
+		ncalls = 0;
+		errors = 0;
+		for (i = 0; i < clnt->nworkers; ++i) {
+			ncalls += __atomic_load_n(&clnt->workers[i]->ncalls, __ATOMIC_RELAXED);
+			errors += __atomic_load_n(&clnt->workers[i]->errors, __ATOMIC_RELAXED);
+		}
+
+		printf("%lu... ", ncalls);
+		fflush(stdout);
+
+		if (errors >= clnt->conf.max_errors)
+			break;
+	}
+
+	for (i = 0; i < clnt->nworkers; ++i)
+		__atomic_store_n(&clnt->workers[i]->stop, 1, __ATOMIC_RELAXED);
+
+	for (i = 0; i < clnt->nworkers; ++i) {
+		struct sumclnt *worker = clnt->workers[i];
+
+		pthread_join(worker->thread, NULL);
+		sumclnt_merge(clnt, worker);
+	}
+
+	if (clnt->errors >= clnt->conf.max_errors)
+		log_error("Too many errors, aborting this run");
+
+	if (clnt->nsnapshots)
+		printf("\n");
+	for (i = 0; i < clnt->nsnapshots; ++i)
+		stress_snapshot_print(&clnt->snapshots[i]);
+
+	return 0;
+}
+
+/*
+ * Add the results of a worker thread to ours
+ */
+void
+sumclnt_merge(struct sumclnt *clnt, const struct sumclnt *worker)
+{
+	unsigned int i;
+
+	clnt->ncalls += worker->ncalls;
+	clnt->errors += worker->errors;
+	clnt->udp_retransmits += worker->udp_retransmits;
+	clnt->udp_timeouts += worker->udp_timeouts;
+	clnt->udp_stale += worker->udp_stale;
+
+	hist_merge(&clnt->send_histogram, &worker->send_histogram);
+	hist_merge(&clnt->recv_histogram, &worker->recv_histogram);
+	hist_merge(&clnt->pipeline_histogram, &worker->pipeline_histogram);
+	hist_merge(&clnt->udp_histogram, &worker->udp_histogram);
+
+	/* All workers started at the same time, and report at the same
+	 * interval, so their n-th snapshots cover the same period */
+	for (i = 0; i < worker->nsnapshots; ++i) {
+		const struct stress_snapshot *other = &worker->snapshots[i];
+		struct stress_snapshot *snap;
+
+		if (i >= clnt->nsnapshots) {
+			clnt->snapshots = realloc(clnt->snapshots, (i + 1) * sizeof(clnt->snapshots[0]));
+			snap = &clnt->snapshots[clnt->nsnapshots++];
+			memset(snap, 0, sizeof(*snap));
+			hist_init(&snap->reply, other->reply.max_usec, clnt->conf.hist_precision);
+		} else {
+			snap = &clnt->snapshots[i];
+		}
+
+		/* Snapshots only count the calls and errors of their
+		 * interval, so they can simply be added up */
+		if (other->time > snap->time)
+			snap->time = other->time;
+		snap->calls += other->calls;
+		snap->errors += other->errors;
+		hist_merge(&snap->reply, &other->reply);
+	}
+}
+
+/*
+ * Take a snapshot of the reply latencies seen during the last
+ * interval, and print it.
+ */
+static void
+sumclnt_report_interval(struct sumclnt *clnt)
+{
+	struct stress_snapshot *snap;
+	struct histogram *h = &clnt->interval_histogram;
+	unsigned long calls = clnt->ncalls;
+	unsigned int errors = clnt->errors;
+	struct timeval now, delta;
+
+	gettimeofday(&now, NULL);
+	if (timercmp(&now, &clnt->next_report, <))
+		return;
+
+	/* Keep the intervals aligned with the start of the run */
+	delta.tv_sec = clnt->conf.interval;
+	delta.tv_usec = 0;
+	timeradd(&clnt->next_report, &delta, &clnt->next_report);
+	if (timercmp(&clnt->next_report, &now, <=))
+		timeradd(&now, &delta, &clnt->next_report);
+
+	timersub(&now, &clnt->start_time, &delta);
+
+	clnt->snapshots = realloc(clnt->snapshots, (clnt->nsnapshots + 1) * sizeof(clnt->snapshots[0]));
+	snap = &clnt->snapshots[clnt->nsnapshots++];
+	snap->time = delta.tv_sec + 1e-6 * delta.tv_usec;
+	snap->calls = calls - clnt->reported_calls;
+	snap->errors = errors - clnt->reported_errors;
+	clnt->reported_calls = calls;
+	clnt->reported_errors = errors;
+
+	/* Hand the interval histogram to the snapshot, and start a new one */
+	snap->reply = *h;
+	hist_init(h, h->max_usec, clnt->conf.hist_precision);
+
+	/* Worker threads are quiet; their snapshots are printed after
+	 * they have been merged */
+	if (clnt->epfd < 0)
+		stress_snapshot_print(snap);
+}
+
+static void
+stress_snapshot_print(const struct stress_snapshot *snap)
+{
+	printf("%8.1fs: %lu calls, %u errors; reply p50 %.3f p90 %.3f p99 %.3f p99.9 %.3f max %.3f msec\n",
+			snap->time, snap->calls, snap->errors,
+			1e-3 * hist_percentile(&snap->reply, 50),
+			1e-3 * hist_percentile(&snap->reply, 90),
+			1e-3 * hist_percentile(&snap->reply, 99),
+			1e-3 * hist_percentile(&snap->reply, 99.9),
+			1e-3 * snap->reply.max);
+	fflush(stdout);
+}
+
+/*
+ * Check whether the runtime given on the command line is up
+ */
+static int
+stress_runtime_expired(const struct stress_opts *opt)
+{
+	struct timeval now;
+
+	if (!timerisset(&opt->end_time))
+		return 0;
+
+	gettimeofday(&now, NULL);
+	return timercmp(&now, &opt->end_time, >=);
+}
+
 static void
 sumclnt_record_send_delay(struct sumclnt *clnt, struct sumjob *job)
 {
@@ -484,18 +1224,27 @@ sumclnt_record_send_delay(struct sumclnt *clnt, struct sumjob *job)
 }
 
 static void
-sumclnt_record_recv_delay(struct sumclnt *clnt, struct sumjob *job)
+sumclnt_record_recv_delay(struct sumclnt *clnt, struct sumjob *job, struct sumcall *call)
 {
-	hist_record(&clnt->recv_histogram, &job->recv.begin);
+	unsigned long usec = hist_delay(&call->begin);
+
+	hist_add(job->recv_histogram, usec);
+	if (clnt->conf.interval)
+		hist_add(&clnt->interval_histogram, usec);
 }
 
 static int
 sumjob_connect(struct sumclnt *clnt, struct sumjob *job)
 {
+	int rv;
+
 	if (job->fd >= 0)
 		return 0;
 
-	job->fd = socket(PF_INET, SOCK_STREAM, 0);
+	if (job->proto == IPPROTO_UDP)
+		job->fd = socket(PF_INET, SOCK_DGRAM, 0);
+	else
+		job->fd = socket(PF_INET, SOCK_STREAM, 0);
 	if (job->fd < 0) {
 		if (errno == EMFILE || errno == ENFILE)
 			job->mummified = 1;
@@ -520,7 +1269,12 @@ sumjob_connect(struct sumclnt *clnt, struct sumjob *job)
 	/* Set NDELAY for non-blocking connect */
 	fcntl(job->fd, F_SETFL, O_NDELAY);
 
-	if (connect(job->fd, (struct sockaddr *) &clnt->svc_addr, clnt->svc_addrlen) >= 0) {
+	if (job->proto == IPPROTO_UDP)
+		rv = connect(job->fd, (struct sockaddr *) &clnt->udp_addr, clnt->udp_addrlen);
+	else
+		rv = connect(job->fd, (struct sockaddr *) &clnt->svc_addr, clnt->svc_addrlen);
+
+	if (rv >= 0) {
 		job->last_activity = 'C';
 	} else
 	if (errno == EINPROGRESS) {
@@ -549,47 +1303,176 @@ sumjob_send(struct sumclnt *clnt, struct sumjob *job)
 	unsigned int nbytes, avail;
 	int rv;
 
-	if (job->proto != IPPROTO_TCP) {
-		fprintf(stderr, "%s: protocol not supported\n", __func__);
-		return -1;
-	}
-
 	if (job->fd < 0) {
 		fprintf(stderr, "%s: not connected\n", __func__);
 		return -1;
 	}
 
-	avail = job->send.len - job->send.pos;
-	nbytes = random() % job->send.len;
-	if (nbytes == 0)
-		nbytes = 1;
-	else if (nbytes > avail)
-		nbytes = avail;
+	if (job->proto == IPPROTO_UDP) {
+		/* Datagrams go out in one piece */
+		rv = send(job->fd, job->send.buf, job->send.len, MSG_DONTWAIT);
+		if (rv < 0) {
+			if (errno == EAGAIN)
+				return 0;
+			perror("send");
+			return -1;
+		}
 
-	rv = send(job->fd, job->send.buf + job->send.pos, nbytes, MSG_DONTWAIT);
-	if (rv < 0) {
-		perror("sendmsg");
-		return -1;
-	}
+		job->send.pos = job->send.len;
+	} else {
+		avail = job->send.len - job->send.pos;
+		nbytes = stress_random(job->random_state) % job->send.len;
+		if (nbytes == 0)
+			nbytes = 1;
+		else if (nbytes > avail)
+			nbytes = avail;
+
+		rv = send(job->fd, job->send.buf + job->send.pos, nbytes, MSG_DONTWAIT);
+		if (rv < 0) {
+			perror("sendmsg");
+			return -1;
+		}
 
-	job->last_activity = 'x';
-	job->send.pos += rv;
-	nbytes = rv;
+		job->last_activity = 'x';
+		job->send.pos += rv;
+	}
 
 	if (job->send.pos >= job->send.len) {
 		/* We sent everything */
 		job->last_activity = 'X';
 
-		sumclnt_record_send_delay(clnt, job);
-		gettimeofday(&job->recv.begin, NULL);
+		if (job->proto == IPPROTO_TCP)
+			sumclnt_record_send_delay(clnt, job);
+		sumjob_call_sent(clnt, job);
+
+		if (sumjob_next_call(job) < 0)
+			log_fatal("Failed to build packet");
 	}
 
 	return 0;
 }
 
+/*
+ * The packet in the send buffer has gone out. Remember the call,
+ * so that we can match it with the reply.
+ */
+static void
+sumjob_call_sent(struct sumclnt *clnt, struct sumjob *job)
+{
+	struct sumcall *call = NULL;
+	unsigned int i;
+
+	for (i = 0; i < job->window; ++i) {
+		if (!job->calls[i].active) {
+			call = &job->calls[i];
+			break;
+		}
+	}
+
+	if (call == NULL)
+		log_fatal("%s: more than %u calls in flight", job->name, job->window);
+
+	memset(call, 0, sizeof(*call));
+	call->active = 1;
+	call->xid = job->xid;
+	call->sum = job->sum;
+	gettimeofday(&call->begin, NULL);
+
+	if (job->proto == IPPROTO_UDP) {
+		/* Hold on to the packet in case we need to retransmit */
+		call->buf = job->send.buf;
+		call->len = job->send.len;
+		job->send.buf = NULL;
+
+		__sumjob_set_timeout(&call->deadline, clnt->conf.udp_timeout * 1000UL);
+	}
+
+	job->ninflight++;
+	job->nsent++;
+
+	if (job->send.buf)
+		free(job->send.buf);
+	memset(&job->send, 0, sizeof(job->send));
+}
+
+/*
+ * We either received the reply to this call, or gave up on it.
+ */
+static void
+sumjob_call_done(struct sumclnt *clnt, struct sumjob *job, struct sumcall *call)
+{
+	if (call->buf)
+		free(call->buf);
+	memset(call, 0, sizeof(*call));
+
+	job->ninflight--;
+	job->ncalls++;
+
+	if (job->ncalls >= job->max_calls) {
+		job->last_activity = '@';
+		sumjob_close(job);
+	} else
+	if (sumjob_next_call(job) < 0)
+		log_fatal("Failed to rebuild packet");
+}
+
+/*
+ * Build the next packet, unless we're still busy sending one, the
+ * window is full, or we have already sent all our calls.
+ */
+static int
+sumjob_next_call(struct sumjob *job)
+{
+	if (job->send.len != 0
+	 || job->ninflight >= job->window
+	 || job->nsent >= job->max_calls)
+		return 0;
+
+	return sumjob_build_packet(job);
+}
+
+/*
+ * Retransmit UDP calls whose reply is overdue, and give up on those
+ * that have been retransmitted too often already.
+ */
+static void
+sumjob_retransmit(struct sumclnt *clnt, struct sumjob *job)
+{
+	struct timeval now;
+	unsigned int i;
+
+	gettimeofday(&now, NULL);
+	for (i = 0; i < job->window && job->fd >= 0; ++i) {
+		struct sumcall *call = &job->calls[i];
+
+		if (!call->active || timercmp(&now, &call->deadline, <))
+			continue;
+
+		if (call->retransmits >= clnt->conf.udp_retries) {
+			job->last_activity = 't';
+			clnt->udp_timeouts++;
+			__atomic_add_fetch(&clnt->errors, 1, __ATOMIC_RELAXED);
+			sumjob_call_done(clnt, job, call);
+			continue;
+		}
+
+		if (send(job->fd, call->buf, call->len, MSG_DONTWAIT) < 0 && errno != EAGAIN)
+			log_error("%s: unable to retransmit call: %m", job->name);
+
+		call->retransmits++;
+		clnt->udp_retransmits++;
+		job->last_activity = 'T';
+
+		/* Back off exponentially, like the RPC library does */
+		__sumjob_set_timeout(&call->deadline,
+				(clnt->conf.udp_timeout * 1000UL) << call->retransmits);
+	}
+}
+
 static int
 sumjob_recv(struct sumclnt *clnt, struct sumjob *job)
 {
+	struct sumcall *call;
 	unsigned int want;
 	int rv;
 
@@ -606,18 +1489,24 @@ sumjob_recv(struct sumclnt *clnt, struct sumjob *job)
 
 	want = job->recv.len - job->recv.pos;
 	rv = recv(job->fd, job->recv.buf + job->recv.pos, want, MSG_DONTWAIT);
-	if (rv == 0) {
+	if (rv == 0 && job->proto == IPPROTO_TCP) {
 		log_error("%s: unexpected end of file on socket", __func__);
 		return -1;
 	}
 	if (rv < 0) {
+		if (errno == EAGAIN)
+			return 0;
 		log_error("%s: recv error on socket: %m", __func__);
 		return -1;
 	}
 
 	job->last_activity = 'r';
 	job->recv.pos += rv;
-	if (job->proto == IPPROTO_TCP && job->recv.pos == 4 && job->recv.len == 4) {
+	if (job->proto == IPPROTO_UDP) {
+		/* A datagram is always a complete message */
+		job->recv.len = job->recv.pos;
+	} else
+	if (job->recv.pos == 4 && job->recv.len == 4) {
 		uint32_t marker;
 
 		/* We received the record marker */
@@ -629,41 +1518,55 @@ sumjob_recv(struct sumclnt *clnt, struct sumjob *job)
 
 		if (marker < 16)
 			log_fatal("%s: short RPC record from server (%u bytes)", __func__, marker);
+		if (marker > job->recv.size)
+			log_fatal("%s: RPC record from server too large (%u bytes)", __func__, marker);
 		job->recv.len = marker;
 		job->recv.pos = 0;
 	}
 
 	if (job->recv.pos >= job->recv.len) {
 		/* We've received the entire message */
-		if (sumjob_check_reply(job) < 0)
+		if (sumjob_check_reply(job, &call) < 0)
 			log_fatal("%s: bad reply from server", __func__);
 
-		sumclnt_record_recv_delay(clnt, job);
-		job->last_activity = 'R';
-		job->ncalls++;
-		clnt->ncalls++;
+		/* Set up the buffer for the next reply */
+		job->recv.pos = 0;
+		job->recv.len = (job->proto == IPPROTO_TCP)? 4 : job->recv.size;
 
-		if (job->ncalls < job->max_calls) {
-			sumjob_drop_buffers(job);
-			if (sumjob_build_packet(job) < 0)
-				log_fatal("Failed to rebuild packet");
-		} else {
-			job->last_activity = '@';
-			sumjob_close(job);
+		if (call == NULL) {
+			/* Reply to a call we retransmitted, and which
+			 * has been answered or given up on already */
+			clnt->udp_stale++;
+			return 0;
 		}
+
+		sumclnt_record_recv_delay(clnt, job, call);
+		job->last_activity = 'R';
+		__atomic_add_fetch(&clnt->ncalls, 1, __ATOMIC_RELAXED);
+
+		sumjob_call_done(clnt, job, call);
 	}
 
 	return 0;
 }
 
+/*
+ * Decode the reply, and find the call it belongs to. For UDP, we may
+ * see replies to calls that we have forgotten about already; in
+ * this case, *callp is set to NULL.
+ */
 int
-sumjob_check_reply(struct sumjob *job)
+sumjob_check_reply(struct sumjob *job, struct sumcall **callp)
 {
+	struct sumcall *call = NULL;
 	struct rpc_msg msg;
 	u_int32_t sum = 12345678;
+	unsigned int i;
 	XDR xdrs;
 	int rv = -1;
 
+	*callp = NULL;
+
 	memset(&msg, 0, sizeof(msg));
 
 	msg.rm_reply.rp_acpt.ar_results.where = (caddr_t) &sum;
@@ -675,8 +1578,19 @@ sumjob_check_reply(struct sumjob *job)
 		goto failed;
 	}
 
-	if (msg.rm_xid != job->xid) {
-		log_error("Reply XID doesn't match (expect 0x%08x, got 0x%08x)", msg.rm_xid, job->xid);
+	for (i = 0; i < job->window; ++i) {
+		if (job->calls[i].active && job->calls[i].xid == msg.rm_xid) {
+			call = &job->calls[i];
+			break;
+		}
+	}
+
+	if (call == NULL) {
+		if (job->proto == IPPROTO_UDP) {
+			rv = 0;
+			goto failed;
+		}
+		log_error("Reply XID 0x%08x doesn't match any call in flight", msg.rm_xid);
 		goto failed;
 	}
 	if (msg.rm_direction != REPLY) {
@@ -692,11 +1606,12 @@ sumjob_check_reply(struct sumjob *job)
 		goto failed;
 	}
 
-	if (sum != job->sum) {
-		log_error("Reply has wrong sum (expect %u, got %u)", job->sum, sum);
+	if (sum != call->sum) {
+		log_error("Reply has wrong sum (expect %u, got %u)", call->sum, sum);
 		goto failed;
 	}
 
+	*callp = call;
 	rv = 0;
 
 failed:
@@ -726,24 +1641,38 @@ sumjob_set_timeout(struct sumclnt *clnt, struct sumjob *job)
 struct sumjob *
 sumjob_new(struct sumclnt *clnt, unsigned int jobid, unsigned int num_ints)
 {
-	static char namebuf[128];
+	char namebuf[128];
 	struct sumjob *job = calloc(1, sizeof(*job));
 
-	snprintf(namebuf, sizeof(namebuf), "job%u", jobid);
+	snprintf(namebuf, sizeof(namebuf), "%sjob%u", clnt->name, jobid);
 	job->name = strdup(namebuf);
 	job->id = jobid;
 
-	job->max_calls = random() % clnt->conf.max_calls;
+	/* Every job makes at least one call */
+	job->random_state = &clnt->random_state;
+
+	job->max_calls = stress_random(job->random_state) % clnt->conf.max_calls;
+	if (job->max_calls == 0)
+		job->max_calls = 1;
 	job->num_ints = num_ints;
 
 	gettimeofday(&job->ctime, NULL);
 
-	/* For now, only do TCP */
-	job->proto = IPPROTO_TCP;
+	/* The UDP jobs come after the TCP jobs */
+	if (jobid >= clnt->conf.njobs) {
+		job->proto = IPPROTO_UDP;
+		job->recv_histogram = &clnt->udp_histogram;
+	} else {
+		job->proto = IPPROTO_TCP;
+		if (clnt->conf.window > 1)
+			job->recv_histogram = &clnt->pipeline_histogram;
+		else
+			job->recv_histogram = &clnt->recv_histogram;
+	}
 	job->fd = -1;
 
-	job->xid = xid;
-	job->xid += job->max_calls;
+	job->window = clnt->conf.window;
+	job->calls = calloc(job->window, sizeof(job->calls[0]));
 
 	if (sumjob_build_packet(job) < 0) {
 		sumjob_free(job);
@@ -766,6 +1695,8 @@ sumjob_build_packet(struct sumjob *job)
 
 	job->send.size = 128 + 4 * job->num_ints;
 	job->send.buf = malloc(job->send.size);
+	job->send.pos = 0;
+	job->xid = __atomic_fetch_add(&xid, 1, __ATOMIC_RELAXED);
 
 	xdrmem_create(&xdrs, (char *) job->send.buf, job->send.size, XDR_ENCODE);
 
@@ -789,7 +1720,7 @@ sumjob_build_packet(struct sumjob *job)
 
 	input = calloc(job->num_ints, sizeof(input[0]));
 	for (i = 0, job->sum = 0; i < job->num_ints; ++i) {
-		input[i] = random();
+		input[i] = stress_random(job->random_state);
 		job->sum += input[i];
 	}
 
@@ -885,8 +1816,8 @@ __pollflags(int f)
 static void
 sumjob_print(const struct sumjob *job)
 {
-	printf("Job %s: fd=%d send=<buf=%p,len=%u,pos=%u> recv=<buf=%p,len=%u,pos=%u>\n",
-	       job->name, job->fd,
+	printf("Job %s: fd=%d calls=%u/%u inflight=%u send=<buf=%p,len=%u,pos=%u> recv=<buf=%p,len=%u,pos=%u>\n",
+	       job->name, job->fd, job->ncalls, job->max_calls, job->ninflight,
 	       job->send.buf, job->send.len, job->send.pos,
 	       job->recv.buf, job->recv.len, job->recv.pos);
 	if (job->pollfd) {
@@ -914,6 +1845,16 @@ sumjob_free(struct sumjob *job)
 
 	sumjob_drop_buffers(job);
 
+	if (job->calls) {
+		unsigned int i;
+
+		for (i = 0; i < job->window; ++i) {
+			if (job->calls[i].buf)
+				free(job->calls[i].buf);
+		}
+		free(job->calls);
+	}
+
 	sumjob_close(job);
 
 	if (job->name)
@@ -953,7 +1894,8 @@ timeout_update(struct timeout *tmo, const struct timeval *expire)
 	if (value == 0)
 		return -1;
 
-	tmo->current = value;
+	if (tmo->current < 0 || value < tmo->current)
+		tmo->current = value;
 	return value;
 }
 
@@ -963,71 +1905,331 @@ timeout_value(const struct timeout *tmo)
 	return tmo->current;
 }
 
+/*
+ * A xorshift64* PRNG returning 31 bits, like random(). glibc's random()
+ * takes a process wide lock, which would serialize the worker threads.
+ */
+static unsigned long
+stress_random(uint64_t *state)
+{
+	uint64_t x = *state;
+
+	x ^= x >> 12;
+	x ^= x << 25;
+	x ^= x >> 27;
+	*state = x;
+	return (x * 0x2545F4914F6CDD1DULL) >> 33;
+}
+
+/*
+ * Histogram helper functions.
+ *
+ * Delays are recorded in microseconds. Values below 2 * sub_count are
+ * counted exactly; above that, every power of two is split into
+ * sub_count buckets, so the relative error of any value we report is
+ * below 1 / sub_count. This is the same bucketing scheme that HdrHistogram
+ * uses.
+ */
+static inline unsigned int
+__msb(unsigned long value)
+{
+	return 8 * sizeof(value) - 1 - __builtin_clzl(value);
+}
+
+static unsigned int
+hist_index(const struct histogram *h, unsigned long usec)
+{
+	unsigned int shift;
+
+	if (usec < (2UL << h->sub_bits))
+		return usec;
+
+	shift = __msb(usec) - h->sub_bits;
+	return (shift << h->sub_bits) + (usec >> shift);
+}
+
+/* Smallest value that goes into the given bucket */
+static unsigned long
+hist_bucket_low(const struct histogram *h, unsigned int idx)
+{
+	unsigned int shift;
+
+	if (idx < (2U << h->sub_bits))
+		return idx;
+
+	shift = (idx >> h->sub_bits) - 1;
+	return (unsigned long) (idx - (shift << h->sub_bits)) << shift;
+}
+
+/* Largest value that goes into the given bucket */
+static unsigned long
+hist_bucket_high(const struct histogram *h, unsigned int idx)
+{
+	return hist_bucket_low(h, idx + 1) - 1;
+}
+
+/*
+ * Set up a histogram for values up to max_usec, with the given
+ * number of significant decimal digits.
+ */
 static void
-hist_init(struct histogram *h, double xrange)
+hist_init(struct histogram *h, unsigned long max_usec, unsigned int precision)
 {
+	unsigned long sub_count = 1;
+
 	memset(h, 0, sizeof(*h));
-	h->xrange = xrange;
-	h->xscale = HIST_MAX * 1 / xrange;
+
+	while (precision--)
+		sub_count *= 10;
+
+	h->sub_bits = 1;
+	while ((1UL << h->sub_bits) < 2 * sub_count)
+		h->sub_bits++;
+
+	h->max_usec = max_usec;
+	h->nbuckets = hist_index(h, max_usec) + 1;
+	h->values = calloc(h->nbuckets, sizeof(h->values[0]));
 }
 
 static void
-hist_record(struct histogram *h, const struct timeval *t0)
+hist_destroy(struct histogram *h)
+{
+	free(h->values);
+	h->values = NULL;
+}
+
+/* Return the time elapsed since t0, in usec */
+static unsigned long
+hist_delay(const struct timeval *t0)
 {
 	struct timeval now, delta;
-	double delay;
-	unsigned int idx;
 
 	gettimeofday(&now, NULL);
 	if (timercmp(t0, &now, >)) {
 		/* send time in the future?! */
-		delay = h->xrange;
-	} else {
-		timersub(&now, t0, &delta);
-		delay = delta.tv_sec + 1e-6 * delta.tv_usec;
+		return 0;
 	}
 
-	idx = HIST_MAX * (delay * h->xscale);
-	if (idx >= HIST_MAX)
-		idx = HIST_MAX - 1;
-	h->values[idx]++;
+	timersub(&now, t0, &delta);
+	return delta.tv_sec * 1000000UL + delta.tv_usec;
+}
+
+static void
+hist_add(struct histogram *h, unsigned long usec)
+{
+	if (h->count == 0 || usec < h->min)
+		h->min = usec;
+	if (usec > h->max)
+		h->max = usec;
+	h->count++;
+	h->sum += usec;
+
+	if (usec > h->max_usec) {
+		h->overflow++;
+		usec = h->max_usec;
+	}
+	h->values[hist_index(h, usec)]++;
 }
 
+/* Add the samples of another histogram with the same range and precision */
 static void
-hist_print(struct histogram *h, unsigned int nlines)
+hist_merge(struct histogram *h, const struct histogram *other)
 {
-	double scaled[HIST_MAX], f;
-	unsigned int max_value = 0;
 	unsigned int i;
-	int scanline;
 
-	for (i = 0; i < HIST_MAX; ++i) {
-		if (h->values[i] >= max_value)
-			max_value = h->values[i];
+	if (other->count == 0)
+		return;
+
+	for (i = 0; i < h->nbuckets && i < other->nbuckets; ++i)
+		h->values[i] += other->values[i];
+
+	if (h->count == 0 || other->min < h->min)
+		h->min = other->min;
+	if (other->max > h->max)
+		h->max = other->max;
+	h->count += other->count;
+	h->overflow += other->overflow;
+	h->sum += other->sum;
+}
+
+static void
+hist_record(struct histogram *h, const struct timeval *t0)
+{
+	hist_add(h, hist_delay(t0));
+}
+
+/*
+ * Return the upper limit of the bucket containing the given
+ * percentile, in usec.
+ */
+static unsigned long
+hist_percentile(const struct histogram *h, double pct)
+{
+	double threshold = h->count * pct / 100;
+	unsigned long seen = 0, value;
+	unsigned int i;
+
+	if (h->count == 0)
+		return 0;
+
+	for (i = 0; i < h->nbuckets; ++i) {
+		seen += h->values[i];
+		if (seen >= threshold)
+			break;
 	}
-	if (max_value == 0)
+
+	/* Values beyond the histogram range all end up in the last bucket */
+	if (i >= h->nbuckets - 1 && h->overflow)
+		return h->max;
+
+	value = hist_bucket_high(h, i);
+	if (value > h->max)
+		value = h->max;
+	return value;
+}
+
+static void
+hist_print_json(FILE *fp, const struct histogram *h)
+{
+	fprintf(fp, "{ \"count\": %lu, \"min\": %.6f, \"mean\": %.6f, ",
+			h->count, 1e-6 * h->min, h->count? 1e-6 * h->sum / h->count : 0);
+	fprintf(fp, "\"p50\": %.6f, \"p90\": %.6f, \"p99\": %.6f, \"p99.9\": %.6f, ",
+			1e-6 * hist_percentile(h, 50),
+			1e-6 * hist_percentile(h, 90),
+			1e-6 * hist_percentile(h, 99),
+			1e-6 * hist_percentile(h, 99.9));
+	fprintf(fp, "\"max\": %.6f, \"overflow\": %lu }", 1e-6 * h->max, h->overflow);
+}
+
+static FILE *
+stress_open_summary(const char *path)
+{
+	FILE *fp;
+
+	if (!strcmp(path, "-"))
+		return stdout;
+
+	if ((fp = fopen(path, "w")) == NULL)
+		log_error("cannot open %s: %m", path);
+	return fp;
+}
+
+/*
+ * Write a summary of the run in JSON format. Latencies are in seconds.
+ */
+static int
+stress_write_summary(struct sumclnt *clnt, const char *path, FILE *fp)
+{
+	struct timeval now, delta;
+	double elapsed;
+	unsigned int i;
+
+	gettimeofday(&now, NULL);
+	timersub(&now, &clnt->start_time, &delta);
+	elapsed = delta.tv_sec + 1e-6 * delta.tv_usec;
+
+	fprintf(fp, "{\n");
+	fprintf(fp, "  \"jobs\": %u,\n", clnt->conf.njobs);
+	fprintf(fp, "  \"max_calls\": %u,\n", clnt->conf.max_calls);
+	fprintf(fp, "  \"window\": %u,\n", clnt->conf.window);
+	fprintf(fp, "  \"engine\": \"%s\",\n", clnt->conf.engine == STRESS_ENGINE_EPOLL? "epoll" : "poll");
+	fprintf(fp, "  \"threads\": %u,\n", clnt->nworkers? clnt->nworkers : 1);
+	fprintf(fp, "  \"udp_jobs\": %u,\n", clnt->conf.udp_jobs);
+	fprintf(fp, "  \"runtime\": %.3f,\n", elapsed);
+	fprintf(fp, "  \"calls\": %lu,\n", clnt->ncalls);
+	fprintf(fp, "  \"calls_per_sec\": %.1f,\n", elapsed > 0? clnt->ncalls / elapsed : 0);
+	fprintf(fp, "  \"errors\": %u,\n", clnt->errors);
+	fprintf(fp, "  \"udp_retransmits\": %lu,\n", clnt->udp_retransmits);
+	fprintf(fp, "  \"udp_timeouts\": %lu,\n", clnt->udp_timeouts);
+	fprintf(fp, "  \"udp_stale\": %lu,\n", clnt->udp_stale);
+	fprintf(fp, "  \"send\": ");
+	hist_print_json(fp, &clnt->send_histogram);
+	fprintf(fp, ",\n  \"recv\": ");
+	hist_print_json(fp, &clnt->recv_histogram);
+	fprintf(fp, ",\n  \"pipeline\": ");
+	hist_print_json(fp, &clnt->pipeline_histogram);
+	fprintf(fp, ",\n  \"udp\": ");
+	hist_print_json(fp, &clnt->udp_histogram);
+	fprintf(fp, ",\n  \"workers\": [");
+	for (i = 0; i < clnt->nworkers; ++i) {
+		const struct sumclnt *worker = clnt->workers[i];
+
+		fprintf(fp, "%s\n    { \"jobs\": %u, \"calls\": %lu, \"errors\": %u }",
+				i? "," : "", worker->njobs, worker->ncalls, worker->errors);
+	}
+	fprintf(fp, "\n  ]");
+	fprintf(fp, ",\n  \"intervals\": [");
+	for (i = 0; i < clnt->nsnapshots; ++i) {
+		const struct stress_snapshot *snap = &clnt->snapshots[i];
+
+		fprintf(fp, "%s\n    { \"time\": %.3f, \"calls\": %lu, \"errors\": %u, \"reply\": ",
+				i? "," : "", snap->time, snap->calls, snap->errors);
+		hist_print_json(fp, &snap->reply);
+		fprintf(fp, " }");
+	}
+	fprintf(fp, "\n  ]\n}\n");
+
+	if (fp == stdout) {
+		fflush(fp);
+	} else
+	if (fclose(fp) == EOF) {
+		log_error("error writing %s: %m", path);
+		return -1;
+	}
+
+	return 0;
+}
+
+/*
+ * Print percentiles, followed by a bar chart with one line per power of two
+ */
+static void
+hist_print(struct histogram *h)
+{
+	unsigned long groups[64], max_value = 0;
+	unsigned int i, first = 64, ngroups = 0;
+
+	if (h->count == 0)
 		return;
-	f = 1.0 * nlines / max_value;
-	for (i = 0; i < HIST_MAX; ++i)
-		scaled[i] = h->values[i] * f;
-
-	for (scanline = nlines; scanline >= 0; --scanline) {
-		for (i = 0; i < HIST_MAX; ++i) {
-			double v = scaled[i] - scanline;
-			if (v > 0.5)
-				putc('#', stdout);
-			else if (v > 0)
-				putc('.', stdout);
-			else
-				putc(' ', stdout);
+
+	printf("%lu samples, min %.3f msec, mean %.3f msec\n",
+			h->count, 1e-3 * h->min, 1e-3 * h->sum / h->count);
+	printf("p50 %.3f  p90 %.3f  p99 %.3f  p99.9 %.3f  max %.3f msec\n",
+			1e-3 * hist_percentile(h, 50),
+			1e-3 * hist_percentile(h, 90),
+			1e-3 * hist_percentile(h, 99),
+			1e-3 * hist_percentile(h, 99.9),
+			1e-3 * h->max);
+	if (h->overflow)
+		printf("%lu samples exceeded the histogram range of %.3f msec\n",
+				h->overflow, 1e-3 * h->max_usec);
+
+	memset(groups, 0, sizeof(groups));
+	for (i = 0; i < h->nbuckets; ++i) {
+		unsigned long low = hist_bucket_low(h, i);
+		unsigned int g = low? __msb(low) + 1 : 0;
+
+		groups[g] += h->values[i];
+		if (h->values[i]) {
+			if (g < first)
+				first = g;
+			if (g >= ngroups)
+				ngroups = g + 1;
 		}
-		printf("| %u\n", (unsigned int) (scanline / f));
-	}
-	for (i = 0; i < HIST_MAX; i += 10)
-		printf("+---------");
-	printf("+\n");
-	for (i = 0; i < HIST_MAX; i += 10)
-		printf("%-10u", (int) (i * h->xrange / HIST_MAX * 1000));
-	printf("%u msec\n", (int) (i * h->xrange / HIST_MAX * 1000));
-}
+	}
+
+	for (i = first; i < ngroups; ++i) {
+		if (groups[i] > max_value)
+			max_value = groups[i];
+	}
 
+	printf("\n");
+	for (i = first; i < ngroups; ++i) {
+		unsigned long low = i? 1UL << (i - 1) : 0;
+		unsigned int width = 50 * groups[i] / max_value;
+
+		printf("%12.3f msec |%-50.*s| %lu\n", 1e-3 * low, width,
+				"##################################################",
+				groups[i]);
+	}
+}
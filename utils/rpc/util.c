@@ -22,6 +22,7 @@
  * Utility functions
  */
 #include <sys/wait.h>
+#include <sys/resource.h>
 #include <unistd.h>
 #include <signal.h>
 #include <arpa/inet.h>
@@ -439,3 +440,29 @@ rpctest_pidfile_kill(const char *path)
 {
 	return __rpctest_pidfile_kill(path, SIGTERM);
 }
+
+/*
+ * Raise the soft limit on open files to the hard limit, so that
+ * stress tests can use as many sockets as the system permits.
+ * Returns the resulting soft limit.
+ */
+unsigned long
+rpctest_raise_nofile_limit(void)
+{
+	struct rlimit rlim;
+
+	if (getrlimit(RLIMIT_NOFILE, &rlim) < 0) {
+		log_error("cannot get RLIMIT_NOFILE: %m");
+		return 1024;
+	}
+
+	if (rlim.rlim_cur < rlim.rlim_max) {
+		rlim.rlim_cur = rlim.rlim_max;
+		if (setrlimit(RLIMIT_NOFILE, &rlim) < 0) {
+			log_error("cannot raise RLIMIT_NOFILE to %lu: %m", (unsigned long) rlim.rlim_max);
+			getrlimit(RLIMIT_NOFILE, &rlim);
+		}
+	}
+
+	return rlim.rlim_cur;
+}